@@ -18,6 +18,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import logging
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
@@ -27,6 +28,84 @@ from art.utils import get_labels_np_array
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on `nb_samples * nb_classes` for computing the gradients of all classes with a single call in
+# `_logit_difference_gradient`, which holds that many input-sized gradients in memory at once:
+_MAX_ALL_CLASS_GRADIENTS = 2048
+
+
+def _target_and_other_indices(z, target, target_idx=None):
+    """
+    Find the index of the target class and the index of the class with the largest logit among all other classes.
+
+    :param z: An array with the logits.
+    :type z: `np.ndarray`
+    :param target: An array with the target class (one-hot encoded). Ignored if `target_idx` is provided.
+    :type target: `np.ndarray`
+    :param target_idx: An array with the indices of the target classes, if already computed from `target`.
+    :type target_idx: `np.ndarray`
+    :return: A tuple holding the target class indices and the indices of the largest non-target logits.
+    :rtype: `(np.ndarray, np.ndarray)`
+    """
+    i_target = np.argmax(target, axis=1) if target_idx is None else target_idx
+
+    # The largest non-target logit is one of the two largest logits, which a partial sort finds without masking `z`;
+    # the last column holds the largest logit:
+    top2 = np.argpartition(z, -2, axis=1)[:, -2:]
+    i_other = np.where(top2[:, 1] == i_target, top2[:, 0], top2[:, 1])
+
+    return i_target, i_other
+
+
+def _take_rows(a, idx, buffer):
+    """
+    Gather rows of an array into the leading rows of a preallocated buffer.
+
+    :param a: The array to gather the rows from.
+    :type a: `np.ndarray`
+    :param idx: An array with the indices of the rows, which must all be valid.
+    :type idx: `np.ndarray`
+    :param buffer: An array with the same trailing dimensions and type as `a` and at least `len(idx)` rows.
+    :type buffer: `np.ndarray`
+    :return: A view of the leading rows of `buffer` holding the gathered rows.
+    :rtype: `np.ndarray`
+    """
+    # np.take buffers its output to report invalid indices in the default mode, which mode='clip' avoids:
+    return np.take(a, idx, axis=0, out=buffer[:idx.shape[0]], mode='clip')
+
+
+def _logit_difference_gradient(class_gradient, x, i_add, i_sub, nb_classes):
+    """
+    Compute the gradient of the difference between the logits `i_add` and `i_sub` of each sample.
+
+    Classifiers compute the gradients for an array of labels with one backward pass over the whole batch per distinct
+    label. If the labels to add and to subtract need more passes together than there are classes, the gradients of all
+    classes are computed with a single call instead, and the two required ones are taken from them for each sample.
+    This trades memory for passes, as the call returns `nb_classes` gradients per sample instead of one, hence it is
+    only done as long as `nb_samples * nb_classes` does not exceed `_MAX_ALL_CLASS_GRADIENTS`.
+
+    :param class_gradient: The function computing the per-class derivatives, e.g. `Attack._class_gradient`.
+    :type class_gradient: `Callable`
+    :param x: Sample input with shape as expected by the model.
+    :type x: `np.ndarray`
+    :param i_add: An array with the indices of the logits to add.
+    :type i_add: `np.ndarray`
+    :param i_sub: An array with the indices of the logits to subtract.
+    :type i_sub: `np.ndarray`
+    :param nb_classes: The number of classes of the classifier.
+    :type nb_classes: `int`
+    :return: An array with the gradients, whose first dimension is the batch size.
+    :rtype: `np.ndarray`
+    """
+    if x.shape[0] * nb_classes <= _MAX_ALL_CLASS_GRADIENTS and \
+            np.unique(i_add).shape[0] + np.unique(i_sub).shape[0] > nb_classes:
+        gradients = class_gradient(x, label=None, logits=True)
+        rows = np.arange(x.shape[0])
+        return gradients[rows, i_add] - gradients[rows, i_sub]
+
+    gradient = class_gradient(x, label=i_add, logits=True)
+    gradient -= class_gradient(x, label=i_sub, logits=True)
+    return gradient
+
 
 class CarliniL2Method(Attack):
     """
@@ -37,10 +116,11 @@ class CarliniL2Method(Attack):
     """
     attack_params = Attack.attack_params + ['confidence', 'targeted', 'learning_rate', 'max_iter',
                                             'binary_search_steps', 'initial_const', 'max_halving', 'max_doubling',
-                                            'batch_size']
+                                            'batch_size', 'parallel_c', 'early_stop_tol', 'compute_success_rate']
 
     def __init__(self, classifier, confidence=0.0, targeted=True, learning_rate=0.01, binary_search_steps=10,
-                 max_iter=10, initial_const=0.01, max_halving=5, max_doubling=5, batch_size=128, expectation=None):
+                 max_iter=10, initial_const=0.01, max_halving=5, max_doubling=5, batch_size=128, expectation=None,
+                 parallel_c=False, early_stop_tol=0.0, compute_success_rate=True):
         """
         Create a Carlini L_2 attack instance.
 
@@ -71,6 +151,16 @@ class CarliniL2Method(Attack):
         :param expectation: An expectation over transformations to be applied when computing
                             classifier gradients and predictions.
         :type expectation: :class:`ExpectationOverTransformations`
+        :param parallel_c: Instead of the binary search over `c`, run the optimization for the `binary_search_steps`
+                constants `initial_const * 2**k` concurrently on copies of each batch. This requires
+                `binary_search_steps` times more memory, but fewer and larger classifier calls.
+        :type parallel_c: `bool`
+        :param early_stop_tol: Stop optimizing a sample within a binary search step once an adversarial example with
+                squared l2 distance below this value has been found. The default of 0 never stops early.
+        :type early_stop_tol: `float`
+        :param compute_success_rate: Log the success rate of the attack at the end of `generate`. This requires
+                additional predictions on the whole input, which are skipped if `False` or if INFO logging is disabled.
+        :type compute_success_rate: `bool`
         """
         super(CarliniL2Method, self).__init__(classifier)
 
@@ -83,7 +173,10 @@ class CarliniL2Method(Attack):
                   'max_halving': max_halving,
                   'max_doubling': max_doubling,
                   'batch_size': batch_size,
-                  'expectation': expectation
+                  'expectation': expectation,
+                  'parallel_c': parallel_c,
+                  'early_stop_tol': early_stop_tol,
+                  'compute_success_rate': compute_success_rate
                   }
         assert self.set_params(**kwargs)
 
@@ -93,25 +186,36 @@ class CarliniL2Method(Attack):
         # Smooth arguments of arctanh by multiplying with this constant to avoid division by zero:
         self._tanh_smoother = 0.999999
 
-    def _loss(self, x, x_adv, target, c):
+    def _loss(self, x, x_adv, target, c, target_idx=None, l2dist=None):
         """
         Compute the objective function value.
 
-        :param x: An array with the original input.
+        :param x: An array with the original input. Ignored if `l2dist` is provided.
         :type x: `np.ndarray`
         :param x_adv: An array with the adversarial input.
         :type x_adv: `np.ndarray`
-        :param target: An array with the target class (one-hot encoded).
+        :param target: An array with the target class (one-hot encoded). Ignored if `target_idx` is provided.
         :type target: `np.ndarray`
         :param c: Weight of the loss term aiming for classification as target.
         :type c: `float`
-        :return: A tuple holding the current logits, l2 distance and overall loss.
-        :rtype: `(float, float, float)`
+        :param target_idx: An array with the indices of the target classes, if already computed from `target`.
+        :type target_idx: `np.ndarray`
+        :param l2dist: An array with the squared l2 distances between `x` and `x_adv`, if already computed.
+        :type l2dist: `np.ndarray`
+        :return: A tuple holding the indices of the largest non-target logits, the current l2 distance and overall
+                 loss.
+        :rtype: `(np.ndarray, np.ndarray, np.ndarray)`
         """
-        l2dist = np.sum(np.square(x - x_adv).reshape(x.shape[0], -1), axis=1)
-        z = self._predict(np.array(x_adv, dtype=NUMPY_DTYPE), logits=True)
-        z_target = np.sum(z * target, axis=1)
-        z_other = np.max(z * (1 - target) + (np.min(z, axis=1) - 1)[:, np.newaxis] * target, axis=1)
+        if l2dist is None:
+            # Square the difference in place to avoid allocating a second input-sized temporary:
+            l2dist = x - x_adv
+            np.square(l2dist, out=l2dist)
+            l2dist = np.sum(l2dist.reshape(x.shape[0], -1), axis=1)
+
+        z = self._predict(np.asarray(x_adv, dtype=NUMPY_DTYPE), logits=True)
+        i_target, i_other = _target_and_other_indices(z, target, target_idx)
+        z_target = z[np.arange(z.shape[0]), i_target]
+        z_other = z[np.arange(z.shape[0]), i_other]
 
         # The following differs from the exact definition given in Carlini and Wagner (2016). There (page 9, left
         # column, last equation), the maximum is taken over Z_other - Z_target (or Z_target - Z_other respectively)
@@ -121,57 +225,135 @@ class CarliniL2Method(Attack):
 
         if self.targeted:
             # if targeted, optimize for making the target class most likely
-            loss = np.maximum(z_other - z_target + self.confidence, np.zeros(x.shape[0]))
+            loss = np.maximum(z_other - z_target + self.confidence, np.zeros(x_adv.shape[0], dtype=NUMPY_DTYPE))
         else:
             # if untargeted, optimize for making any other class most likely
-            loss = np.maximum(z_target - z_other + self.confidence, np.zeros(x.shape[0]))
+            loss = np.maximum(z_target - z_other + self.confidence, np.zeros(x_adv.shape[0], dtype=NUMPY_DTYPE))
+
+        # Scale in place so that a float64 `c` does not promote the loss to float64:
+        loss *= c
+        loss += l2dist
 
-        return z, l2dist, c*loss + l2dist
+        return i_other, l2dist, loss
 
-    def _gradient_of_loss(self, z, target, x, x_adv, x_adv_tanh, c, clip_min, clip_max):
+    def _line_search_losses(self, x, x_adv_tanh, perturbation_tanh, target, c, lr, clip_min, clip_max,
+                            target_idx=None, buffers=None):
         """
-        Compute the gradient of the loss function.
+        Evaluate the objective function for several candidate learning rates per sample with a single classifier call.
 
-        :param z: An array with the current logits.
-        :type z: `np.ndarray`
+        :param x: An array with the original input.
+        :type x: `np.ndarray`
+        :param x_adv_tanh: An array with the adversarial input in tanh space.
+        :type x_adv_tanh: `np.ndarray`
+        :param perturbation_tanh: An array with the perturbation to be applied in tanh space.
+        :type perturbation_tanh: `np.ndarray`
         :param target: An array with the target class (one-hot encoded).
         :type target: `np.ndarray`
+        :param c: Weight of the loss term aiming for classification as target.
+        :type c: `np.ndarray`
+        :param lr: An array of shape `(nb_samples, nb_candidates)` with the candidate learning rates.
+        :type lr: `np.ndarray`
+        :param clip_min: Minimum clipping value.
+        :type clip_min: `float`
+        :param clip_max: Maximum clipping value.
+        :type clip_max: `float`
+        :param target_idx: An array with the indices of the target classes, if already computed from `target`.
+        :type target_idx: `np.ndarray`
+        :param buffers: Two flat arrays of type `NUMPY_DTYPE` with at least `lr.size` times the number of features per
+                sample elements, which are used to hold the candidates in tanh and original space.
+        :type buffers: `(np.ndarray, np.ndarray)`
+        :return: A tuple holding the indices of the largest non-target logits, l2 distances and overall losses, each
+                 with leading dimensions `(nb_samples, nb_candidates)`.
+        :rtype: `(np.ndarray, np.ndarray, np.ndarray)`
+        """
+        nb_candidates = lr.shape[1]
+        if target_idx is None:
+            target_idx = np.argmax(target, axis=1)
+        # The learning rates are applied in NUMPY_DTYPE, exactly as in the final update of the adversarial input:
+        lr_mult = lr.astype(NUMPY_DTYPE).reshape(lr.shape + (1,) * (len(x.shape) - 1))
+
+        shape = lr.shape + x.shape[1:]
+        if buffers is None:
+            x_adv_tanh_candidates = np.empty(shape, dtype=NUMPY_DTYPE)
+            x_adv_candidates = np.empty(shape, dtype=NUMPY_DTYPE)
+        else:
+            size = int(np.prod(shape))
+            x_adv_tanh_candidates = buffers[0][:size].reshape(shape)
+            x_adv_candidates = buffers[1][:size].reshape(shape)
+
+        np.multiply(lr_mult, perturbation_tanh[:, np.newaxis], out=x_adv_tanh_candidates)
+        x_adv_tanh_candidates += x_adv_tanh[:, np.newaxis]
+        np.tanh(x_adv_tanh_candidates, out=x_adv_candidates)
+        x_adv_candidates = self._tanh_to_original(x_adv_tanh_candidates, clip_min, clip_max, tanh_x=x_adv_candidates,
+                                                  out=x_adv_candidates).reshape((-1,) + x.shape[1:])
+
+        # The distances are reduced over a flat `(nb_samples, nb_candidates, nb_features)` layout, where the original
+        # input is broadcast over the candidates instead of being repeated for each of them:
+        l2dist = x_adv_candidates.reshape(lr.shape + (-1,)) - x.reshape((x.shape[0], 1, -1))
+        np.square(l2dist, out=l2dist)
+        l2dist = np.sum(l2dist, axis=2).reshape(-1)
+
+        i_other, l2dist, loss = self._loss(None, x_adv_candidates, None, np.repeat(c, nb_candidates),
+                                           target_idx=np.repeat(target_idx, nb_candidates), l2dist=l2dist)
+
+        return i_other.reshape(lr.shape), l2dist.reshape(lr.shape), loss.reshape(lr.shape)
+
+    def _gradient_of_loss(self, i_other, target, x, x_adv, tanh_x_adv, c, clip_min, clip_max, target_idx=None):
+        """
+        Compute the gradient of the loss function.
+
+        :param i_other: An array with the indices of the largest non-target logits, as returned by `_loss`.
+        :type i_other: `np.ndarray`
+        :param target: An array with the target class (one-hot encoded). Ignored if `target_idx` is provided.
+        :type target: `np.ndarray`
         :param x: An array with the original input.
         :type x: `np.ndarray`
         :param x_adv: An array with the adversarial input.
         :type x_adv: `np.ndarray`
-        :param x_adv_tanh: An array with the adversarial input in tanh space.
-        :type x_adv_tanh: `np.ndarray`
+        :param tanh_x_adv: An array holding `np.tanh` of the adversarial input in tanh space.
+        :type tanh_x_adv: `np.ndarray`
         :param c: Weight of the loss term aiming for classification as target.
         :type c: `float`
         :param clip_min: Minimum clipping value.
         :type clip_min: `float`
         :param clip_max: Maximum clipping value.
         :type clip_max: `float`
+        :param target_idx: An array with the indices of the target classes, if already computed from `target`.
+        :type target_idx: `np.ndarray`
         :return: An array with the gradient of the loss function.
         :type target: `np.ndarray`
         """
+        i_target = np.argmax(target, axis=1) if target_idx is None else target_idx
         if self.targeted:
-            i_sub = np.argmax(target, axis=1)
-            i_add = np.argmax(z * (1 - target) + (np.min(z, axis=1) - 1)[:, np.newaxis] * target, axis=1)
+            i_sub, i_add = i_target, i_other
         else:
-            i_add = np.argmax(target, axis=1)
-            i_sub = np.argmax(z * (1 - target) + (np.min(z, axis=1) - 1)[:, np.newaxis] * target, axis=1)
+            i_add, i_sub = i_target, i_other
 
-        loss_gradient = self._class_gradient(x_adv, label=i_add, logits=True)
-        loss_gradient -= self._class_gradient(x_adv, label=i_sub, logits=True)
-        loss_gradient = loss_gradient.reshape(x.shape)
+        loss_gradient = _logit_difference_gradient(self._class_gradient, x_adv, i_add, i_sub,
+                                                   self.classifier.nb_classes)
 
-        c_mult = c
-        for _ in range(len(x.shape)-1):
-            c_mult = c_mult[:, np.newaxis]
+        # The remaining chain is elementwise per sample, hence it runs on `(nb_samples, nb_features)` views: the loops
+        # then only ever broadcast a column of per-sample factors against a 2D array, whatever the input shape is.
+        nb_samples = x.shape[0]
+        loss_gradient = loss_gradient.reshape(nb_samples, -1)
+        c_mult = np.reshape(c, (-1, 1))
 
+        # A single scratch buffer holds first the gradient of the distance term and then the Jacobian of the tanh
+        # transformation, so that the whole chain runs without further input-sized temporaries:
+        scratch = np.subtract(x_adv.reshape(nb_samples, -1), x.reshape(nb_samples, -1))
+        scratch *= 2
         loss_gradient *= c_mult
-        loss_gradient += 2 * (x_adv - x)
-        loss_gradient *= (clip_max - clip_min)
-        loss_gradient *= (1 - np.square(np.tanh(x_adv_tanh))) / (2 * self._tanh_smoother)
+        loss_gradient += scratch
+        # Clipping values may be given per feature, hence their range is flattened like the features of a sample:
+        loss_gradient *= np.broadcast_to(clip_max - clip_min, x.shape[1:]).reshape(1, -1)
 
-        return loss_gradient
+        tanh_x_adv = tanh_x_adv.reshape(nb_samples, -1)
+        np.multiply(tanh_x_adv, tanh_x_adv, out=scratch)
+        np.subtract(1, scratch, out=scratch)
+        scratch /= (2 * self._tanh_smoother)
+        loss_gradient *= scratch
+
+        return loss_gradient.reshape(x.shape)
 
     def _original_to_tanh(self, x_original, clip_min, clip_max):
         """
@@ -190,12 +372,24 @@ class CarliniL2Method(Attack):
         # we multiply arguments with _tanh_smoother. It appears this is what Carlini and Wagner
         # (2016) are alluding to in their footnote 8. However, it is not clear how their proposed trick
         # ("instead of scaling by 1/2 we scale by 1/2 + eps") works in detail.
-        x_tanh = np.clip(x_original, clip_min, clip_max)
-        x_tanh = (x_tanh - clip_min) / (clip_max - clip_min)
-        x_tanh = np.arctanh(((x_tanh * 2) - 1) * self._tanh_smoother)
+        scale = 2 * self._tanh_smoother / (clip_max - clip_min)
+        # arctanh(u) = log((1 + u) / (1 - u)) / 2 for the affine image u of x_original is evaluated as the difference
+        # of two logarithms, whose arguments are computed from the distances to clip_min and clip_max. This avoids
+        # the cancellation in 1 - u and 1 + u close to the clipping values:
+        x_clipped = np.clip(x_original, clip_min, clip_max)
+        x_tanh = np.subtract(x_clipped, clip_min)
+        x_tanh *= scale
+        x_tanh += 1 - self._tanh_smoother
+        np.log(x_tanh, out=x_tanh)
+        np.subtract(clip_max, x_clipped, out=x_clipped)
+        x_clipped *= scale
+        x_clipped += 1 - self._tanh_smoother
+        np.log(x_clipped, out=x_clipped)
+        x_tanh -= x_clipped
+        x_tanh *= 0.5
         return x_tanh
 
-    def _tanh_to_original(self, x_tanh, clip_min, clip_max):
+    def _tanh_to_original(self, x_tanh, clip_min, clip_max, tanh_x=None, out=None):
         """
         Transform input from tanh to original space.
 
@@ -205,11 +399,346 @@ class CarliniL2Method(Attack):
         :type clip_min: `float`
         :param clip_max: Maximum clipping value.
         :type clip_max: `float`
+        :param tanh_x: An array holding `np.tanh(x_tanh)`, if already available.
+        :type tanh_x: `np.ndarray`
+        :param out: An array to store the transformed input in, which may be `tanh_x` itself.
+        :type out: `np.ndarray`
         :return: An array holding the transformed input.
         :rtype: `np.ndarray`
         """
-        x_original = (np.tanh(x_tanh) / self._tanh_smoother + 1) / 2
-        return x_original * (clip_max - clip_min) + clip_min
+        if tanh_x is None:
+            tanh_x = np.tanh(x_tanh)
+        # (tanh_x / _tanh_smoother + 1) / 2 * (clip_max - clip_min) + clip_min as a single multiply-add:
+        x_original = np.multiply(tanh_x, (clip_max - clip_min) / (2 * self._tanh_smoother), out=out)
+        np.add(x_original, (clip_max + clip_min) / 2, out=x_original)
+        return x_original
+
+    def _tanh_and_original(self, x_tanh, clip_min, clip_max):
+        """
+        Transform input from tanh to original space and also return the intermediate `np.tanh(x_tanh)`, which is
+        needed again when computing the gradient of the loss.
+
+        :param x_tanh: An array with the input to be transformed.
+        :type x_tanh: `np.ndarray`
+        :param clip_min: Minimum clipping value.
+        :type clip_min: `float`
+        :param clip_max: Maximum clipping value.
+        :type clip_max: `float`
+        :return: A tuple holding `np.tanh(x_tanh)` and the transformed input.
+        :rtype: `(np.ndarray, np.ndarray)`
+        """
+        tanh_x = np.tanh(x_tanh)
+        return tanh_x, self._tanh_to_original(x_tanh, clip_min, clip_max, tanh_x=tanh_x)
+
+    def _batch_to_tanh(self, x_batch, clip_min, clip_max):
+        """
+        Transform a batch from original to tanh space and also return `np.tanh` of the result, which is the starting
+        point of the tanh cache of the optimization.
+
+        :param x_batch: A batch of original examples.
+        :type x_batch: `np.ndarray`
+        :param clip_min: Minimum clipping value.
+        :type clip_min: `float`
+        :param clip_max: Maximum clipping value.
+        :type clip_max: `float`
+        :return: A tuple holding the batch in tanh space and `np.tanh` of it.
+        :rtype: `(np.ndarray, np.ndarray)`
+        """
+        x_batch_tanh = self._original_to_tanh(x_batch, clip_min, clip_max).astype(NUMPY_DTYPE, copy=False)
+        return x_batch_tanh, np.tanh(x_batch_tanh)
+
+    def _generate_bss(self, x_batch, x_batch_tanh, tanh_x_batch, y_batch, target_idx_batch, c, clip_min, clip_max,
+                      buffers=None):
+        """
+        Run the optimization of one binary search step, i.e. for a fixed batch of constants.
+
+        :param x_batch: A batch of original examples.
+        :type x_batch: `np.ndarray`
+        :param x_batch_tanh: The batch of original examples in tanh space.
+        :type x_batch_tanh: `np.ndarray`
+        :param tanh_x_batch: An array holding `np.tanh(x_batch_tanh)`.
+        :type tanh_x_batch: `np.ndarray`
+        :param y_batch: A batch of targets (one-hot encoded).
+        :type y_batch: `np.ndarray`
+        :param target_idx_batch: The indices of the target classes of the batch.
+        :type target_idx_batch: `np.ndarray`
+        :param c: A batch of constants.
+        :type c: `np.ndarray`
+        :param clip_min: Minimum clipping value.
+        :type clip_min: `float`
+        :param clip_max: Maximum clipping value.
+        :type clip_max: `float`
+        :param buffers: Two flat arrays of type `NUMPY_DTYPE` which hold the candidates of the line search, large enough
+                for `max(max_halving, max_doubling)` candidates of each sample of the batch.
+        :type buffers: `(np.ndarray, np.ndarray)`
+        :return: A tuple holding the smallest l2 distances of successful adversarial examples (`np.inf` where the attack
+                 never succeeded), the corresponding adversarial examples (original examples where the attack never
+                 succeeded) and flags indicating whether the attack succeeded at any iteration.
+        :rtype: `(np.ndarray, np.ndarray, np.ndarray)`
+        """
+        # Initialize placeholders for best l2 distance and attack found in this binary search step
+        best_l2dist = np.inf * np.ones(x_batch.shape[0])
+        best_x_adv_batch = x_batch.copy()
+        alive_idx = np.flatnonzero(c < self._c_upper_bound)
+        if alive_idx.size == 0:
+            return best_l2dist, best_x_adv_batch, np.zeros(x_batch.shape[0], dtype=bool)
+
+        # Per-sample factors are broadcast against the batch by reshaping them with these trailing dimensions:
+        trailing_dims = (1,) * (len(x_batch.shape) - 1)
+
+        # The factors of the candidate learning rates and the steps of the line search are the same in every iteration:
+        halving_factors = 2.0 ** -np.arange(self.max_halving)
+        doubling_factors = 2.0 ** np.arange(1, self.max_doubling + 1)
+        doubling_steps = np.arange(self.max_doubling)
+
+        # The statistics in the debug messages require passes over the batch, which are skipped without DEBUG logging:
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        lr = self.learning_rate * np.ones(x_batch.shape[0])
+
+        # Initialize perturbation in tanh space:
+        x_adv_batch = x_batch.copy()
+        x_adv_batch_tanh = x_batch_tanh.copy()
+        tanh_x_adv_batch = tanh_x_batch.copy()
+
+        # Samples whose c exceeds _c_upper_bound are never optimized, hence they are not passed to the
+        # classifier; they keep their original input (zero distance) and an infinite loss:
+        i_other_alive, l2dist_alive, loss_alive = self._loss(x_batch[alive_idx], x_adv_batch[alive_idx],
+                                                             y_batch[alive_idx], c[alive_idx],
+                                                             target_idx=target_idx_batch[alive_idx])
+        i_other = np.zeros(x_batch.shape[0], dtype=i_other_alive.dtype)
+        l2dist = np.zeros(x_batch.shape[0], dtype=l2dist_alive.dtype)
+        loss = np.inf * np.ones(x_batch.shape[0], dtype=loss_alive.dtype)
+        i_other[alive_idx], l2dist[alive_idx], loss[alive_idx] = i_other_alive, l2dist_alive, loss_alive
+        attack_success = (loss - l2dist <= 0)
+        overall_attack_success = attack_success
+
+        # Per-sample buffers of the line search, which are refilled at every iteration instead of being reallocated.
+        # The indices of the largest non-target logits and the l2 distances belonging to best_lr are reused when the
+        # adversarial samples are finally updated instead of querying the classifier again; they are only read where
+        # best_lr has been set in the same iteration, hence they need no reset:
+        best_loss = np.empty_like(loss)
+        best_lr = np.empty(x_batch.shape[0])
+        halving = np.empty(x_batch.shape[0])
+        i_other_best_lr = np.empty_like(i_other)
+        l2dist_best_lr = np.empty_like(l2dist)
+
+        for it in range(self.max_iter):
+            logger.debug('Iteration step %i out of %i', it, self.max_iter)
+            if debug:
+                logger.debug('Average Loss: %f', np.mean(loss))
+                logger.debug('Average L2Dist: %f', np.mean(l2dist))
+                logger.debug('Average Margin Loss: %f', np.mean(loss-l2dist))
+                logger.debug('Current number of succeeded attacks: %i out of %i', int(np.sum(attack_success)),
+                             len(attack_success))
+
+            improved_adv = attack_success & (l2dist < best_l2dist)
+            if debug:
+                logger.debug('Number of improved L2 distances: %i', int(np.sum(improved_adv)))
+            if np.any(improved_adv):
+                # Masked copies update the best results in place, without gathering the improved samples first:
+                np.copyto(best_l2dist, l2dist, where=improved_adv)
+                np.copyto(best_x_adv_batch, x_adv_batch, where=improved_adv.reshape((-1,) + trailing_dims))
+
+            # Samples for which an adversarial example within early_stop_tol has been found are not optimized further.
+            # Gather and scatter the active samples with an index vector instead of boolean masks:
+            done = best_l2dist < self.early_stop_tol
+            active = (c < self._c_upper_bound) & (lr > 0) & ~done
+            active_idx = np.flatnonzero(active)
+            nb_active = active_idx.shape[0]
+            logger.debug('Number of samples with c < _c_upper_bound, lr > 0 and not done: %i out of %i',
+                         nb_active, x_batch.shape[0])
+            if nb_active == 0:
+                break
+
+            # compute gradient:
+            logger.debug('Compute loss gradient')
+            perturbation_tanh = -self._gradient_of_loss(i_other[active_idx], y_batch[active_idx],
+                                                        x_batch[active_idx], x_adv_batch[active_idx],
+                                                        tanh_x_adv_batch[active_idx], c[active_idx], clip_min,
+                                                        clip_max, target_idx=target_idx_batch[active_idx])
+
+            # perform line search to optimize perturbation
+            # first, halve the learning rate until perturbation actually decreases the loss:
+            np.copyto(best_loss, loss)
+            best_lr.fill(0)
+            halving.fill(0)
+
+            # All candidate learning rates lr, lr/2, lr/4, ... are evaluated with a single classifier call; the
+            # search then stops for each sample at the first candidate which decreases the loss:
+            rows = np.arange(nb_active)
+            lr_halving = lr[active_idx, np.newaxis] * halving_factors
+            i_other_halving, l2dist_halving, loss_halving = self._line_search_losses(
+                x_batch[active_idx], x_adv_batch_tanh[active_idx], perturbation_tanh, y_batch[active_idx],
+                c[active_idx], lr_halving, clip_min, clip_max, target_idx=target_idx_batch[active_idx],
+                buffers=buffers)
+
+            # loss still holds the values before the line search at this point:
+            stop_halving = ~(loss_halving >= loss[active_idx, np.newaxis])
+            halving[active_idx] = np.where(np.any(stop_halving, axis=1), np.argmax(stop_halving, axis=1) + 1,
+                                           self.max_halving)
+            last = halving[active_idx].astype(int) - 1
+            if debug:
+                logger.debug('Number of halving steps performed: %s', str(halving[active_idx]))
+
+            loss[active_idx] = loss_halving[rows, last]
+            l2dist[active_idx] = l2dist_halving[rows, last]
+            lr[active_idx] = lr_halving[rows, last]
+            if debug:
+                logger.debug('New Average Loss: %f', np.mean(loss))
+                logger.debug('New Average L2Dist: %f', np.mean(l2dist))
+                logger.debug('New Average Margin Loss: %f', np.mean(loss-l2dist))
+
+            improved = loss[active_idx] < best_loss[active_idx]
+            improved_idx = active_idx[improved]
+            best_lr[improved_idx] = lr[improved_idx]
+            best_loss[improved_idx] = loss[improved_idx]
+            i_other_best_lr[improved_idx] = i_other_halving[rows, last][improved]
+            l2dist_best_lr[improved_idx] = l2dist[improved_idx]
+
+            # if no halving was actually required, double the learning rate as long as this
+            # decreases the loss:
+            do_doubling = (halving[active_idx] == 1) & (loss[active_idx] <= best_loss[active_idx])
+            if debug:
+                logger.debug('Doubling to be performed on %i samples', int(np.sum(do_doubling)))
+            if np.any(do_doubling):
+                doubling_idx = active_idx[do_doubling]
+                rows = np.arange(doubling_idx.shape[0])
+                lr_doubling = lr[doubling_idx, np.newaxis] * doubling_factors
+                i_other_doubling, l2dist_doubling, loss_doubling = self._line_search_losses(
+                    x_batch[doubling_idx], x_adv_batch_tanh[doubling_idx], perturbation_tanh[do_doubling],
+                    y_batch[doubling_idx], c[doubling_idx], lr_doubling, clip_min, clip_max,
+                    target_idx=target_idx_batch[doubling_idx], buffers=buffers)
+
+                # The search stops at the first candidate which is worse than the best loss found before it:
+                best_loss_before = np.concatenate((best_loss[doubling_idx, np.newaxis], loss_doubling[:, :-1]),
+                                                  axis=1)
+                best_loss_before = np.minimum.accumulate(best_loss_before, axis=1)
+                stop_doubling = ~(loss_doubling <= best_loss_before)
+                last = np.where(np.any(stop_doubling, axis=1), np.argmax(stop_doubling, axis=1),
+                                self.max_doubling - 1)
+                if debug:
+                    logger.debug('Number of doubling steps performed: %s', str(last + 1))
+
+                loss[doubling_idx] = loss_doubling[rows, last]
+                l2dist[doubling_idx] = l2dist_doubling[rows, last]
+                lr[doubling_idx] = lr_doubling[rows, last]
+                if debug:
+                    logger.debug('New Average Loss: %f', np.mean(loss))
+                    logger.debug('New Average L2Dist: %f', np.mean(l2dist))
+                    logger.debug('New Average Margin Loss: %f', np.mean(loss-l2dist))
+
+                tried = (doubling_steps <= last[:, np.newaxis]) & ~np.isnan(loss_doubling)
+                best = np.argmin(np.where(tried, loss_doubling, np.inf), axis=1)
+                improved = loss_doubling[rows, best] < best_loss[doubling_idx]
+                improved_idx = doubling_idx[improved]
+                best_lr[improved_idx] = lr_doubling[rows, best][improved]
+                best_loss[improved_idx] = loss_doubling[rows, best][improved]
+                i_other_best_lr[improved_idx] = i_other_doubling[rows, best][improved]
+                l2dist_best_lr[improved_idx] = l2dist_doubling[rows, best][improved]
+
+            lr[halving == 1] /= 2
+
+            update_adv = (best_lr[active_idx] > 0)
+            if debug:
+                logger.debug('Number of adversarial samples to be finally updated: %i', int(np.sum(update_adv)))
+
+            if np.any(update_adv):
+                update_idx = active_idx[update_adv]
+                best_lr_mult = best_lr[update_idx].astype(NUMPY_DTYPE).reshape((-1,) + trailing_dims)
+
+                x_adv_batch_tanh[update_idx] = x_adv_batch_tanh[update_idx] + \
+                    best_lr_mult * perturbation_tanh[update_adv]
+                tanh_x_adv_batch[update_idx], x_adv_batch[update_idx] = \
+                    self._tanh_and_original(x_adv_batch_tanh[update_idx], clip_min, clip_max)
+                i_other[update_idx] = i_other_best_lr[update_idx]
+                l2dist[update_idx] = l2dist_best_lr[update_idx]
+                loss[update_idx] = best_loss[update_idx]
+                attack_success = (loss - l2dist <= 0)
+                overall_attack_success = overall_attack_success | attack_success
+
+            # Release the perturbation before the next one is computed, so that both are not held at once:
+            del perturbation_tanh
+
+        # Update depending on attack success:
+        improved_adv = attack_success & (l2dist < best_l2dist)
+        if debug:
+            logger.debug('Number of improved L2 distances: %i', int(np.sum(improved_adv)))
+
+        if np.any(improved_adv):
+            np.copyto(best_l2dist, l2dist, where=improved_adv)
+            np.copyto(best_x_adv_batch, x_adv_batch, where=improved_adv.reshape((-1,) + trailing_dims))
+
+        return best_l2dist, best_x_adv_batch, overall_attack_success
+
+    def _generate_parallel_c(self, x_batch, x_batch_tanh, tanh_x_batch, y_batch, target_idx_batch, clip_min,
+                             clip_max, buffers=None):
+        """
+        Run the optimization for the constants `initial_const * 2**k`, `k < binary_search_steps`, concurrently instead
+        of performing a binary search. These are the constants visited by the binary search as long as the attack keeps
+        failing. Each constant is applied to its own copy of the batch, so that every classifier call covers all of
+        them, and the smallest successful perturbation is kept for each sample.
+
+        :param x_batch: A batch of original examples.
+        :type x_batch: `np.ndarray`
+        :param x_batch_tanh: The batch of original examples in tanh space.
+        :type x_batch_tanh: `np.ndarray`
+        :param tanh_x_batch: An array holding `np.tanh(x_batch_tanh)`.
+        :type tanh_x_batch: `np.ndarray`
+        :param y_batch: A batch of targets (one-hot encoded).
+        :type y_batch: `np.ndarray`
+        :param target_idx_batch: The indices of the target classes of the batch.
+        :type target_idx_batch: `np.ndarray`
+        :param clip_min: Minimum clipping value.
+        :type clip_min: `float`
+        :param clip_max: Maximum clipping value.
+        :type clip_max: `float`
+        :param buffers: Two flat arrays of type `NUMPY_DTYPE` which hold the candidates of the line search, large enough
+                for `max(max_halving, max_doubling)` candidates of each sample of all copies of the batch.
+        :type buffers: `(np.ndarray, np.ndarray)`
+        :return: A batch of adversarial examples.
+        :rtype: `np.ndarray`
+        """
+        nb_const = self.binary_search_steps
+        if nb_const == 0:
+            return x_batch.copy()
+
+        reps = (nb_const,) + (1,) * (len(x_batch.shape) - 1)
+        c = np.repeat(self.initial_const * 2.0 ** np.arange(nb_const), x_batch.shape[0])
+        l2dist, x_adv_batch, _ = self._generate_bss(np.tile(x_batch, reps), np.tile(x_batch_tanh, reps),
+                                                    np.tile(tanh_x_batch, reps), np.tile(y_batch, (nb_const, 1)),
+                                                    np.tile(target_idx_batch, nb_const), c, clip_min, clip_max,
+                                                    buffers=buffers)
+
+        # Samples where no constant led to a successful attack have infinite distance for all of them, so that the
+        # original example held by the first copy is returned:
+        l2dist = l2dist.reshape((nb_const, x_batch.shape[0]))
+        x_adv_batch = x_adv_batch.reshape((nb_const,) + x_batch.shape)
+        best_const = np.argmin(l2dist, axis=0)
+
+        return x_adv_batch[best_const, np.arange(x_batch.shape[0])]
+
+    def _update_const(self, c, c_lower_bound, c_double, attack_success):
+        """
+        Update the trade-off constants of the binary search depending on the success of the attack.
+
+        :param c: A batch of constants.
+        :type c: `np.ndarray`
+        :param c_lower_bound: A batch of lower bound constants.
+        :type c_lower_bound: `np.ndarray`
+        :param c_double: A batch of flags indicating whether the constant should still be doubled on failure.
+        :type c_double: `np.ndarray`
+        :param attack_success: A batch of flags indicating whether the attack succeeded for the current constants.
+        :type attack_success: `np.ndarray`
+        :return: A tuple of three batches of updated constants, lower bound constants and doubling flags.
+        :rtype: `tuple`
+        """
+        c_new = np.where(attack_success, (c_lower_bound + c) / 2,
+                         np.where(c_double, 2 * c, c + (c - c_lower_bound) / 2))
+        c_lower_bound = np.where(attack_success, c_lower_bound, c)
+        c_double = c_double & ~attack_success
+
+        return c_new, c_lower_bound, c_double
 
     def generate(self, x, **kwargs):
         """
@@ -223,7 +752,9 @@ class CarliniL2Method(Attack):
         :return: An array holding the adversarial examples.
         :rtype: `np.ndarray`
         """
-        x_adv = x.astype(NUMPY_DTYPE)
+        # All arrays derived from the input are C-contiguous, so that gathering the rows of samples copies contiguous
+        # blocks whatever the memory layout of `x` is:
+        x_adv = x.astype(NUMPY_DTYPE, order='C')
         (clip_min, clip_max) = self.classifier.clip_values
 
         # Parse and save attack-specific parameters
@@ -241,181 +772,92 @@ class CarliniL2Method(Attack):
 
         # Compute perturbation with implicit batching
         nb_batches = int(np.ceil(x_adv.shape[0] / float(self.batch_size)))
-        for batch_id in range(nb_batches):
-            logger.debug('Processing batch %i out of %i', batch_id, nb_batches)
-
-            batch_index_1, batch_index_2 = batch_id * self.batch_size, (batch_id + 1) * self.batch_size
-            x_batch = x_adv[batch_index_1:batch_index_2]
-            y_batch = y[batch_index_1:batch_index_2]
-
-            # The optimization is performed in tanh space to keep the
-            # adversarial images bounded from clip_min and clip_max.
-            x_batch_tanh = self._original_to_tanh(x_batch, clip_min, clip_max)
-
-            # Initialize binary search:
-            c = self.initial_const * np.ones(x_batch.shape[0])
-            c_lower_bound = np.zeros(x_batch.shape[0])
-            c_double = (np.ones(x_batch.shape[0]) > 0)
-
-            # Initialize placeholders for best l2 distance and attack found so far
-            best_l2dist = np.inf * np.ones(x_batch.shape[0])
-            best_x_adv_batch = x_batch.copy()
-
-            for bss in range(self.binary_search_steps):
-                logger.debug('Binary search step %i out of %i (c_mean==%f)', bss, self.binary_search_steps, np.mean(c))
-                nb_active = int(np.sum(c < self._c_upper_bound))
-                logger.debug('Number of samples with c < _c_upper_bound: %i out of %i', nb_active, x_batch.shape[0])
-                if nb_active == 0:
-                    break
-                lr = self.learning_rate * np.ones(x_batch.shape[0])
-
-                # Initialize perturbation in tanh space:
-                x_adv_batch = x_batch.copy()
-                x_adv_batch_tanh = x_batch_tanh.copy()
-
-                z, l2dist, loss = self._loss(x_batch, x_adv_batch, y_batch, c)
-                attack_success = (loss - l2dist <= 0)
-                overall_attack_success = attack_success
-
-                for it in range(self.max_iter):
-                    logger.debug('Iteration step %i out of %i', it, self.max_iter)
-                    logger.debug('Average Loss: %f', np.mean(loss))
-                    logger.debug('Average L2Dist: %f', np.mean(l2dist))
-                    logger.debug('Average Margin Loss: %f', np.mean(loss-l2dist))
-                    logger.debug('Current number of succeeded attacks: %i out of %i', int(np.sum(attack_success)),
-                                 len(attack_success))
-
-                    improved_adv = attack_success & (l2dist < best_l2dist)
-                    logger.debug('Number of improved L2 distances: %i', int(np.sum(improved_adv)))
-                    if np.sum(improved_adv) > 0:
-                        best_l2dist[improved_adv] = l2dist[improved_adv]
-                        best_x_adv_batch[improved_adv] = x_adv_batch[improved_adv]
-
-                    active = (c < self._c_upper_bound) & (lr > 0)
-                    nb_active = int(np.sum(active))
-                    logger.debug('Number of samples with c < _c_upper_bound and lr > 0: %i out of %i',
-                                 nb_active, x_batch.shape[0])
-                    if nb_active == 0:
-                        break
-
-                    # compute gradient:
-                    logger.debug('Compute loss gradient')
-                    perturbation_tanh = -self._gradient_of_loss(z[active], y_batch[active], x_batch[active],
-                                                                x_adv_batch[active], x_adv_batch_tanh[active],
-                                                                c[active], clip_min, clip_max)
-
-                    # perform line search to optimize perturbation
-                    # first, halve the learning rate until perturbation actually decreases the loss:
-                    prev_loss = loss.copy()
-                    best_loss = loss.copy()
-                    best_lr = np.zeros(x_batch.shape[0])
-                    halving = np.zeros(x_batch.shape[0])
-
-                    for h in range(self.max_halving):
-                        logger.debug('Perform halving iteration %i out of %i', h, self.max_halving)
-                        do_halving = (loss[active] >= prev_loss[active])
-                        logger.debug('Halving to be performed on %i samples', int(np.sum(do_halving)))
-                        if np.sum(do_halving) == 0:
-                            break
-                        active_and_do_halving = active.copy()
-                        active_and_do_halving[active] = do_halving
-
-                        lr_mult = lr[active_and_do_halving]
-                        for _ in range(len(x.shape)-1):
-                            lr_mult = lr_mult[:, np.newaxis]
-
-                        new_x_adv_batch_tanh = x_adv_batch_tanh[active_and_do_halving] + \
-                            lr_mult * perturbation_tanh[do_halving]
-                        new_x_adv_batch = self._tanh_to_original(new_x_adv_batch_tanh, clip_min, clip_max)
-                        _, l2dist[active_and_do_halving], loss[active_and_do_halving] = self._loss(
-                            x_batch[active_and_do_halving], new_x_adv_batch, y_batch[active_and_do_halving],
-                            c[active_and_do_halving])
 
-                        logger.debug('New Average Loss: %f', np.mean(loss))
-                        logger.debug('New Average L2Dist: %f', np.mean(l2dist))
-                        logger.debug('New Average Margin Loss: %f', np.mean(loss-l2dist))
-
-                        best_lr[loss < best_loss] = lr[loss < best_loss]
-                        best_loss[loss < best_loss] = loss[loss < best_loss]
-                        lr[active_and_do_halving] /= 2
-                        halving[active_and_do_halving] += 1
-                    lr[active] *= 2
-
-                    # if no halving was actually required, double the learning rate as long as this
-                    # decreases the loss:
-                    for d in range(self.max_doubling):
-                        logger.debug('Perform doubling iteration %i out of %i', d, self.max_doubling)
-                        do_doubling = (halving[active] == 1) & (loss[active] <= best_loss[active])
-                        logger.debug('Doubling to be performed on %i samples', int(np.sum(do_doubling)))
-                        if np.sum(do_doubling) == 0:
+        # The candidates of the line search are written to two flat buffers, which are large enough for the longer of
+        # both searches on a full batch (tiled once per constant with parallel_c) and are reused throughout the attack:
+        buffer_size = x_adv[:self.batch_size].size * max(self.max_halving, self.max_doubling)
+        if self.parallel_c:
+            buffer_size *= self.binary_search_steps
+        line_search_buffers = (np.empty(buffer_size, dtype=NUMPY_DTYPE), np.empty(buffer_size, dtype=NUMPY_DTYPE))
+
+        # The optimization is performed in tanh space to keep the adversarial images bounded from clip_min and
+        # clip_max. With several batches, the transformation of the next batch runs in a worker thread (NumPy
+        # releases the GIL) while the current batch is being attacked; both only touch disjoint slices of x_adv. A
+        # single batch is transformed inline, which spares starting a thread for nothing to prefetch:
+        pool = ThreadPool(1) if nb_batches > 1 else None
+        try:
+            if pool is not None:
+                next_batch_tanh = pool.apply_async(self._batch_to_tanh, (x_adv[:self.batch_size], clip_min, clip_max))
+
+            for batch_id in range(nb_batches):
+                logger.debug('Processing batch %i out of %i', batch_id, nb_batches)
+
+                batch_index_1, batch_index_2 = batch_id * self.batch_size, (batch_id + 1) * self.batch_size
+                x_batch = x_adv[batch_index_1:batch_index_2]
+                y_batch = np.ascontiguousarray(y[batch_index_1:batch_index_2], dtype=NUMPY_DTYPE)
+
+                if pool is None:
+                    x_batch_tanh, tanh_x_batch = self._batch_to_tanh(x_batch, clip_min, clip_max)
+                else:
+                    x_batch_tanh, tanh_x_batch = next_batch_tanh.get()
+                    if batch_id + 1 < nb_batches:
+                        batch_index_3 = batch_index_2 + self.batch_size
+                        next_batch_tanh = pool.apply_async(self._batch_to_tanh,
+                                                           (x_adv[batch_index_2:batch_index_3], clip_min, clip_max))
+
+                # The target classes are constant for the whole batch:
+                target_idx_batch = np.argmax(y_batch, axis=1)
+
+                if self.parallel_c:
+                    best_x_adv_batch = self._generate_parallel_c(x_batch, x_batch_tanh, tanh_x_batch, y_batch,
+                                                                 target_idx_batch, clip_min, clip_max,
+                                                                 buffers=line_search_buffers)
+                else:
+                    # Initialize binary search:
+                    c = self.initial_const * np.ones(x_batch.shape[0])
+                    c_lower_bound = np.zeros(x_batch.shape[0])
+                    c_double = (np.ones(x_batch.shape[0]) > 0)
+
+                    # Initialize placeholders for best l2 distance and attack found so far
+                    best_l2dist = np.inf * np.ones(x_batch.shape[0])
+                    best_x_adv_batch = x_batch.copy()
+
+                    for bss in range(self.binary_search_steps):
+                        logger.debug('Binary search step %i out of %i (c_mean==%f)', bss, self.binary_search_steps,
+                                     np.mean(c))
+                        nb_active = int(np.sum(c < self._c_upper_bound))
+                        logger.debug('Number of samples with c < _c_upper_bound: %i out of %i', nb_active,
+                                     x_batch.shape[0])
+                        if nb_active == 0:
                             break
-                        active_and_do_doubling = active.copy()
-                        active_and_do_doubling[active] = do_doubling
-                        lr[active_and_do_doubling] *= 2
-
-                        lr_mult = lr[active_and_do_doubling]
-                        for _ in range(len(x.shape)-1):
-                            lr_mult = lr_mult[:, np.newaxis]
-
-                        new_x_adv_batch_tanh = x_adv_batch_tanh[active_and_do_doubling] + \
-                            lr_mult * perturbation_tanh[do_doubling]
-                        new_x_adv_batch = self._tanh_to_original(new_x_adv_batch_tanh, clip_min, clip_max)
-                        _, l2dist[active_and_do_doubling], loss[active_and_do_doubling] = self._loss(
-                            x_batch[active_and_do_doubling], new_x_adv_batch, y_batch[active_and_do_doubling],
-                            c[active_and_do_doubling])
-                        logger.debug('New Average Loss: %f', np.mean(loss))
-                        logger.debug('New Average L2Dist: %f', np.mean(l2dist))
-                        logger.debug('New Average Margin Loss: %f', np.mean(loss-l2dist))
-                        best_lr[loss < best_loss] = lr[loss < best_loss]
-                        best_loss[loss < best_loss] = loss[loss < best_loss]
 
-                    lr[halving == 1] /= 2
-
-                    update_adv = (best_lr[active] > 0)
-                    logger.debug('Number of adversarial samples to be finally updated: %i', int(np.sum(update_adv)))
-
-                    if np.sum(update_adv) > 0:
-                        active_and_update_adv = active.copy()
-                        active_and_update_adv[active] = update_adv
-                        best_lr_mult = best_lr[active_and_update_adv]
-                        for _ in range(len(x.shape) - 1):
-                            best_lr_mult = best_lr_mult[:, np.newaxis]
-
-                        x_adv_batch_tanh[active_and_update_adv] = x_adv_batch_tanh[active_and_update_adv] + \
-                            best_lr_mult * perturbation_tanh[update_adv]
-                        x_adv_batch[active_and_update_adv] = \
-                            self._tanh_to_original(x_adv_batch_tanh[active_and_update_adv], clip_min, clip_max)
-                        z[active_and_update_adv], l2dist[active_and_update_adv], loss[active_and_update_adv] = \
-                            self._loss(x_batch[active_and_update_adv], x_adv_batch[active_and_update_adv],
-                                       y_batch[active_and_update_adv], c[active_and_update_adv])
-                        attack_success = (loss - l2dist <= 0)
-                        overall_attack_success = overall_attack_success | attack_success
-
-                # Update depending on attack success:
-                improved_adv = attack_success & (l2dist < best_l2dist)
-                logger.debug('Number of improved L2 distances: %i', int(np.sum(improved_adv)))
-
-                if np.sum(improved_adv) > 0:
-                    best_l2dist[improved_adv] = l2dist[improved_adv]
-                    best_x_adv_batch[improved_adv] = x_adv_batch[improved_adv]
-
-                c_double[overall_attack_success] = False
-                c[overall_attack_success] = (c_lower_bound + c)[overall_attack_success] / 2
-
-                c_old = c
-                c[~overall_attack_success & c_double] *= 2
-                c[~overall_attack_success & ~c_double] += (c - c_lower_bound)[~overall_attack_success & ~c_double] / 2
-                c_lower_bound[~overall_attack_success] = c_old[~overall_attack_success]
-
-            x_adv[batch_index_1:batch_index_2] = best_x_adv_batch
-
-        adv_preds = np.argmax(self._predict(x_adv), axis=1)
-        if self.targeted:
-            rate = np.sum(adv_preds == np.argmax(y, axis=1)) / x_adv.shape[0]
-        else:
-            preds = np.argmax(self._predict(x), axis=1)
-            rate = np.sum(adv_preds != preds) / x_adv.shape[0]
-        logger.info('Success rate of C&W attack: %.2f%%', 100*rate)
+                        bss_l2dist, bss_x_adv_batch, overall_attack_success = self._generate_bss(
+                            x_batch, x_batch_tanh, tanh_x_batch, y_batch, target_idx_batch, c, clip_min, clip_max,
+                            buffers=line_search_buffers)
+
+                        improved_adv = bss_l2dist < best_l2dist
+                        np.copyto(best_l2dist, bss_l2dist, where=improved_adv)
+                        np.copyto(best_x_adv_batch, bss_x_adv_batch,
+                                  where=improved_adv.reshape((-1,) + (1,) * (len(x_batch.shape) - 1)))
+
+                        c, c_lower_bound, c_double = self._update_const(c, c_lower_bound, c_double,
+                                                                        overall_attack_success)
+
+                x_adv[batch_index_1:batch_index_2] = best_x_adv_batch
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # The success rate costs additional predictions and is only computed if it is going to be logged:
+        if self.compute_success_rate and logger.isEnabledFor(logging.INFO):
+            adv_preds = np.argmax(self._predict(x_adv), axis=1)
+            if self.targeted:
+                rate = np.sum(adv_preds == np.argmax(y, axis=1)) / x_adv.shape[0]
+            else:
+                preds = np.argmax(self._predict(x), axis=1)
+                rate = np.sum(adv_preds != preds) / x_adv.shape[0]
+            logger.info('Success rate of C&W attack: %.2f%%', 100*rate)
 
         return x_adv
 
@@ -444,6 +886,14 @@ class CarliniL2Method(Attack):
         :type max_doubling: `int`
         :param batch_size: Internal size of batches on which adversarial samples are generated.
         :type batch_size: `int`
+        :param parallel_c: Instead of the binary search over `c`, run the optimization for the `binary_search_steps`
+               constants `initial_const * 2**k` concurrently on copies of each batch.
+        :type parallel_c: `bool`
+        :param early_stop_tol: Stop optimizing a sample within a binary search step once an adversarial example with
+               squared l2 distance below this value has been found.
+        :type early_stop_tol: `float`
+        :param compute_success_rate: Log the success rate of the attack at the end of `generate`.
+        :type compute_success_rate: `bool`
         """
         # Save attack-specific parameters
         super(CarliniL2Method, self).set_params(**kwargs)
@@ -463,6 +913,9 @@ class CarliniL2Method(Attack):
         if not isinstance(self.batch_size, (int, np.int)) or self.batch_size < 1:
             raise ValueError("The batch size must be an integer greater than zero.")
 
+        if self.early_stop_tol < 0:
+            raise ValueError("The early stopping tolerance must be non-negative.")
+
         return True
 
 
@@ -472,10 +925,13 @@ class CarliniLInfMethod(Attack):
     norm, i.e. the maximum perturbation applied to each pixel.
     """
     attack_params = Attack.attack_params + ['confidence', 'targeted', 'learning_rate', 'max_iter',
-                                            'max_halving', 'max_doubling', 'eps', 'batch_size']
+                                            'max_halving', 'max_doubling', 'eps', 'batch_size', 'compute_success_rate',
+                                            'tanh_dtype', 'early_stop_patience', 'nb_threads', 'regroup_batches']
 
     def __init__(self, classifier, confidence=0.0, targeted=True, learning_rate=0.01,
-                 max_iter=10, max_halving=5, max_doubling=5, eps=0.3, batch_size=128, expectation=None):
+                 max_iter=10, max_halving=5, max_doubling=5, eps=0.3, batch_size=128, expectation=None,
+                 compute_success_rate=True, tanh_dtype=NUMPY_DTYPE, early_stop_patience=None, nb_threads=1,
+                 regroup_batches=False):
         """
         Create a Carlini L_Inf attack instance.
 
@@ -502,6 +958,25 @@ class CarliniLInfMethod(Attack):
         :param expectation: An expectation over transformations to be applied when computing
                             classifier gradients and predictions.
         :type expectation: :class:`ExpectationOverTransformations`
+        :param compute_success_rate: Log the success rate of the attack at the end of `generate`. This requires
+                additional predictions on the whole input, which are skipped if `False` or if INFO logging is disabled.
+        :type compute_success_rate: `bool`
+        :param tanh_dtype: Floating point type in which the adversarial examples and perturbations in tanh space are
+                stored, e.g. `np.float16` to halve their memory footprint. It may not be wider than `NUMPY_DTYPE`, in
+                which all computations are carried out.
+        :type tanh_dtype: `type`
+        :param early_stop_patience: Stop optimizing a sample once the line search has not decreased its loss for this
+                many consecutive iterations. Such samples are unlikely to succeed and are reverted to the original
+                input. If `None`, samples are optimized for `max_iter` iterations or until the attack succeeds.
+        :type early_stop_patience: `int`
+        :param nb_threads: Number of threads among which the samples are split when building the candidates of the
+                line search. The classifier is still queried once for all of them.
+        :type nb_threads: `int`
+        :param regroup_batches: Keep the optimization state of the whole input instead of one batch at a time, and
+                regroup the samples which are still being optimized into full batches in every iteration. This saves
+                classifier calls as samples succeed, but holds three additional arrays the size of the whole input, six
+                if the clip values of the classifier are given per pixel, instead of arrays the size of one batch.
+        :type regroup_batches: `bool`
         """
         super(CarliniLInfMethod, self).__init__(classifier)
 
@@ -513,7 +988,12 @@ class CarliniLInfMethod(Attack):
                   'max_doubling': max_doubling,
                   'eps': eps,
                   'batch_size': batch_size,
-                  'expectation': expectation
+                  'expectation': expectation,
+                  'compute_success_rate': compute_success_rate,
+                  'tanh_dtype': tanh_dtype,
+                  'early_stop_patience': early_stop_patience,
+                  'nb_threads': nb_threads,
+                  'regroup_batches': regroup_batches
                   }
         assert self.set_params(**kwargs)
 
@@ -521,66 +1001,192 @@ class CarliniLInfMethod(Attack):
         # Smooth arguments of arctanh by multiplying with this constant to avoid division by zero:
         self._tanh_smoother = 0.999999
 
-    def _loss(self, x_adv, target):
+    def _clip_bounds(self, x_original):
+        """
+        Compute the clipping values of the adversarial examples, which stay within `eps` of the original input as well
+        as within the clipping values of the classifier.
+
+        :param x_original: An array with the original input.
+        :type x_original: `np.ndarray`
+        :return: A tuple holding the minimum and maximum clipping values and their difference.
+        :rtype: `(np.ndarray, np.ndarray, np.ndarray)`
+        """
+        (clip_min_per_pixel, clip_max_per_pixel) = self.classifier.clip_values
+        clip_min = np.clip(x_original - self.eps, clip_min_per_pixel, clip_max_per_pixel)
+        clip_max = np.clip(x_original + self.eps, clip_min_per_pixel, clip_max_per_pixel)
+        return clip_min, clip_max, clip_max - clip_min
+
+    def _loss(self, x_adv, target, target_idx=None):
         """
         Compute the objective function value.
 
         :param x_adv: An array with the adversarial input.
         :type x_adv: `np.ndarray`
-        :param target: An array with the target class (one-hot encoded).
+        :param target: An array with the target class (one-hot encoded). Ignored if `target_idx` is provided.
         :type target: `np.ndarray`
-        :return: A tuple holding the current logits and overall loss.
-        :rtype: `(float, float)`
+        :param target_idx: An array with the indices of the target classes, if already computed from `target`.
+        :type target_idx: `np.ndarray`
+        :return: A tuple holding the indices of the largest non-target logits and the overall loss.
+        :rtype: `(np.ndarray, np.ndarray)`
         """
-        z = self._predict(np.array(x_adv, dtype=NUMPY_DTYPE), logits=True)
-        z_target = np.sum(z * target, axis=1)
-        z_other = np.max(z * (1 - target) + (np.min(z, axis=1) - 1)[:, np.newaxis] * target, axis=1)
+        z = self._predict(np.asarray(x_adv, dtype=NUMPY_DTYPE), logits=True)
+        i_target, i_other = _target_and_other_indices(z, target, target_idx)
+        z_target = z[np.arange(z.shape[0]), i_target]
+        z_other = z[np.arange(z.shape[0]), i_other]
 
         if self.targeted:
             # if targeted, optimize for making the target class most likely
-            loss = np.maximum(z_other - z_target + self.confidence, np.zeros(x_adv.shape[0]))
+            loss = np.maximum(z_other - z_target + self.confidence, np.zeros(x_adv.shape[0], dtype=NUMPY_DTYPE))
         else:
             # if untargeted, optimize for making any other class most likely
-            loss = np.maximum(z_target - z_other + self.confidence, np.zeros(x_adv.shape[0]))
+            loss = np.maximum(z_target - z_other + self.confidence, np.zeros(x_adv.shape[0], dtype=NUMPY_DTYPE))
 
-        return z, loss
+        return i_other, loss
 
-    def _gradient_of_loss(self, z, target, x_adv, x_adv_tanh, clip_min, clip_max):
+    def _line_search_losses(self, x_adv_tanh, perturbation_tanh, target, lr, clip_min, clip_max, target_idx=None,
+                            buffers=None, clip_range=None, pool=None):
         """
-        Compute the gradient of the loss function.
+        Evaluate the objective function for several candidate learning rates per sample with a single classifier call.
 
-        :param z: An array with the current logits.
-        :type z: `np.ndarray`
+        :param x_adv_tanh: An array with the adversarial input in tanh space.
+        :type x_adv_tanh: `np.ndarray`
+        :param perturbation_tanh: An array with the perturbation to be applied in tanh space.
+        :type perturbation_tanh: `np.ndarray`
         :param target: An array with the target class (one-hot encoded).
         :type target: `np.ndarray`
-        :param x_adv: An array with the adversarial input.
-        :type x_adv: `np.ndarray`
+        :param lr: An array of shape `(nb_samples, nb_candidates)` with the candidate learning rates.
+        :type lr: `np.ndarray`
+        :param clip_min: Minimum clipping values.
+        :type clip_min: `np.ndarray`
+        :param clip_max: Maximum clipping values.
+        :type clip_max: `np.ndarray`
+        :param target_idx: An array with the indices of the target classes, if already computed from `target`.
+        :type target_idx: `np.ndarray`
+        :param buffers: Two flat arrays of type `NUMPY_DTYPE` with at least `lr.size` times the number of features per
+                sample elements, which are used to hold the candidates in tanh and original space.
+        :type buffers: `(np.ndarray, np.ndarray)`
+        :param clip_range: The difference `clip_max - clip_min`, if already computed.
+        :type clip_range: `np.ndarray`
+        :param pool: A pool of `nb_threads` threads among which the samples are split when building the candidates.
+        :type pool: :class:`multiprocessing.pool.ThreadPool`
+        :return: A tuple holding the indices of the largest non-target logits and overall losses, each with leading
+                 dimensions `(nb_samples, nb_candidates)`.
+        :rtype: `(np.ndarray, np.ndarray)`
+        """
+        nb_candidates = lr.shape[1]
+        if target_idx is None:
+            target_idx = np.argmax(target, axis=1)
+
+        # The learning rates are applied in NUMPY_DTYPE, exactly as in the final update of the adversarial input:
+        lr_mult = lr.astype(NUMPY_DTYPE).reshape(lr.shape + (1,) * (len(x_adv_tanh.shape) - 1))
+
+        shape = lr.shape + x_adv_tanh.shape[1:]
+        if buffers is None:
+            x_adv_tanh_candidates = np.empty(shape, dtype=NUMPY_DTYPE)
+            x_adv_candidates = np.empty(shape, dtype=NUMPY_DTYPE)
+        else:
+            size = int(np.prod(shape))
+            x_adv_tanh_candidates = buffers[0][:size].reshape(shape)
+            x_adv_candidates = buffers[1][:size].reshape(shape)
+
+        if clip_range is None:
+            clip_range = clip_max - clip_min
+
+        def build_candidates(rows):
+            # NumPy releases the GIL in these operations, so that disjoint rows can be processed in parallel:
+            self._line_search_candidates(x_adv_tanh[rows], perturbation_tanh[rows], lr_mult[rows], clip_min[rows],
+                                         clip_max[rows], clip_range[rows], x_adv_tanh_candidates[rows],
+                                         x_adv_candidates[rows])
+
+        if pool is None or self.nb_threads == 1:
+            build_candidates(slice(None))
+        else:
+            chunk_size = int(np.ceil(x_adv_tanh.shape[0] / float(self.nb_threads)))
+            pool.map(build_candidates, [slice(i, i + chunk_size) for i in range(0, x_adv_tanh.shape[0], chunk_size)])
+
+        x_adv_candidates = x_adv_candidates.reshape((-1,) + x_adv_tanh.shape[1:])
+        i_other, loss = self._loss(x_adv_candidates, None, target_idx=np.repeat(target_idx, nb_candidates))
+
+        return i_other.reshape(lr.shape), loss.reshape(lr.shape)
+
+    def _line_search_candidates(self, x_adv_tanh, perturbation_tanh, lr_mult, clip_min, clip_max, clip_range,
+                                x_adv_tanh_candidates, x_adv_candidates):
+        """
+        Write the candidates of the line search in tanh and original space to the given arrays.
+
         :param x_adv_tanh: An array with the adversarial input in tanh space.
         :type x_adv_tanh: `np.ndarray`
+        :param perturbation_tanh: An array with the perturbation to be applied in tanh space.
+        :type perturbation_tanh: `np.ndarray`
+        :param lr_mult: An array with the candidate learning rates, reshaped to broadcast against the candidates.
+        :type lr_mult: `np.ndarray`
+        :param clip_min: Minimum clipping values.
+        :type clip_min: `np.ndarray`
+        :param clip_max: Maximum clipping values.
+        :type clip_max: `np.ndarray`
+        :param clip_range: The difference `clip_max - clip_min`.
+        :type clip_range: `np.ndarray`
+        :param x_adv_tanh_candidates: An array of type `NUMPY_DTYPE` to store the candidates in tanh space in.
+        :type x_adv_tanh_candidates: `np.ndarray`
+        :param x_adv_candidates: An array of type `NUMPY_DTYPE` to store the candidates in original space in.
+        :type x_adv_candidates: `np.ndarray`
+        """
+        # The clipping values are broadcast over the candidates instead of being repeated for each of them:
+        np.multiply(lr_mult, perturbation_tanh[:, np.newaxis], out=x_adv_tanh_candidates)
+        x_adv_tanh_candidates += x_adv_tanh[:, np.newaxis]
+        if np.dtype(self.tanh_dtype) != x_adv_tanh_candidates.dtype:
+            # Round the candidates as the adversarial input in tanh space is stored:
+            x_adv_tanh_candidates[...] = x_adv_tanh_candidates.astype(self.tanh_dtype)
+        np.tanh(x_adv_tanh_candidates, out=x_adv_candidates)
+        self._tanh_to_original(x_adv_tanh_candidates, clip_min[:, np.newaxis], clip_max[:, np.newaxis],
+                               tanh_x=x_adv_candidates, out=x_adv_candidates, clip_range=clip_range[:, np.newaxis])
+
+    def _gradient_of_loss(self, i_other, target, x_adv, tanh_x_adv, clip_min, clip_max, target_idx=None,
+                          clip_range=None):
+        """
+        Compute the gradient of the loss function.
+
+        :param i_other: An array with the indices of the largest non-target logits, as returned by `_loss`.
+        :type i_other: `np.ndarray`
+        :param target: An array with the target class (one-hot encoded). Ignored if `target_idx` is provided.
+        :type target: `np.ndarray`
+        :param x_adv: An array with the adversarial input.
+        :type x_adv: `np.ndarray`
+        :param tanh_x_adv: An array holding `np.tanh` of the adversarial input in tanh space.
+        :type tanh_x_adv: `np.ndarray`
         :param clip_min: Minimum clipping values.
         :type clip_min: `np.ndarray`
         :param clip_max: Maximum clipping values.
         :type clip_max: `np.ndarray`
+        :param target_idx: An array with the indices of the target classes, if already computed from `target`.
+        :type target_idx: `np.ndarray`
+        :param clip_range: The difference `clip_max - clip_min`, if already computed.
+        :type clip_range: `np.ndarray`
         :return: An array with the gradient of the loss function.
         :type target: `np.ndarray`
         """
+        i_target = np.argmax(target, axis=1) if target_idx is None else target_idx
         if self.targeted:
-            i_sub = np.argmax(target, axis=1)
-            i_add = np.argmax(z * (1 - target) + (np.min(z, axis=1) - 1)[:, np.newaxis] * target, axis=1)
+            i_sub, i_add = i_target, i_other
         else:
-            i_add = np.argmax(target, axis=1)
-            i_sub = np.argmax(z * (1 - target) + (np.min(z, axis=1) - 1)[:, np.newaxis] * target, axis=1)
+            i_add, i_sub = i_target, i_other
 
-        loss_gradient = self._class_gradient(x_adv, label=i_add, logits=True)
-        loss_gradient -= self._class_gradient(x_adv, label=i_sub, logits=True)
+        loss_gradient = _logit_difference_gradient(self._class_gradient, x_adv, i_add, i_sub,
+                                                   self.classifier.nb_classes)
         loss_gradient = loss_gradient.reshape(x_adv.shape)
 
-        loss_gradient *= (clip_max - clip_min)
-        loss_gradient *= (1 - np.square(np.tanh(x_adv_tanh))) / (2 * self._tanh_smoother)
+        # Jacobian of the tanh transformation, computed in place from the cached tanh values. It already includes
+        # the scaling by the clipping range, so that the gradient itself is only updated once:
+        tanh_jacobian = np.multiply(tanh_x_adv, tanh_x_adv)
+        np.subtract(1, tanh_jacobian, out=tanh_jacobian)
+        if clip_range is None:
+            clip_range = clip_max - clip_min
+        tanh_jacobian *= clip_range * (1 / (2 * self._tanh_smoother))
+        loss_gradient *= tanh_jacobian
 
         return loss_gradient
 
-    def _original_to_tanh(self, x_original, clip_min, clip_max):
+    def _original_to_tanh(self, x_original, clip_min, clip_max, inv_clip_range=None):
         """
         Transform input from original to tanh space.
 
@@ -590,15 +1196,31 @@ class CarliniLInfMethod(Attack):
         :type clip_min: `np.ndarray`
         :param clip_max: Maximum clipping values.
         :type clip_max: `np.ndarray`
+        :param inv_clip_range: The reciprocal of `clip_max - clip_min`, if already computed.
+        :type inv_clip_range: `np.ndarray`
         :return: An array holding the transformed input.
         :rtype: `np.ndarray`
         """
-        x_tanh = np.clip(x_original, clip_min, clip_max)
-        x_tanh = (x_tanh - clip_min) / (clip_max - clip_min)
-        x_tanh = np.arctanh(((x_tanh * 2) - 1) * self._tanh_smoother)
+        if inv_clip_range is None:
+            inv_clip_range = 1 / (clip_max - clip_min)
+        scale = inv_clip_range * (2 * self._tanh_smoother)
+        # arctanh(u) = log((1 + u) / (1 - u)) / 2 for the affine image u of x_original is evaluated as the difference
+        # of two logarithms, whose arguments are computed from the distances to clip_min and clip_max. This avoids
+        # the cancellation in 1 - u and 1 + u close to the clipping values:
+        x_clipped = np.clip(x_original, clip_min, clip_max)
+        x_tanh = np.subtract(x_clipped, clip_min)
+        x_tanh *= scale
+        x_tanh += 1 - self._tanh_smoother
+        np.log(x_tanh, out=x_tanh)
+        np.subtract(clip_max, x_clipped, out=x_clipped)
+        x_clipped *= scale
+        x_clipped += 1 - self._tanh_smoother
+        np.log(x_clipped, out=x_clipped)
+        x_tanh -= x_clipped
+        x_tanh *= 0.5
         return x_tanh
 
-    def _tanh_to_original(self, x_tanh, clip_min, clip_max):
+    def _tanh_to_original(self, x_tanh, clip_min, clip_max, tanh_x=None, out=None, clip_range=None):
         """
         Transform input from tanh to original space.
 
@@ -608,11 +1230,256 @@ class CarliniLInfMethod(Attack):
         :type clip_min: `np.ndarray`
         :param clip_max: Maximum clipping values.
         :type clip_max: `np.ndarray`
+        :param tanh_x: An array holding `np.tanh(x_tanh)`, if already available.
+        :type tanh_x: `np.ndarray`
+        :param out: An array to store the transformed input in, which may be `tanh_x` itself.
+        :type out: `np.ndarray`
+        :param clip_range: The difference `clip_max - clip_min`, if already computed.
+        :type clip_range: `np.ndarray`
         :return: An array holding the transformed input.
         :rtype: `np.ndarray`
         """
-        x_original = (np.tanh(x_tanh) / self._tanh_smoother + 1) / 2
-        return x_original * (clip_max - clip_min) + clip_min
+        if tanh_x is None:
+            tanh_x = np.tanh(x_tanh)
+        # (tanh_x / _tanh_smoother + 1) / 2 * (clip_max - clip_min) + clip_min as a single multiply-add:
+        if clip_range is None:
+            clip_range = clip_max - clip_min
+        x_original = np.multiply(tanh_x, clip_range * (1 / (2 * self._tanh_smoother)), out=out)
+        np.add(x_original, (clip_max + clip_min) / 2, out=x_original)
+        return x_original
+
+    def _tanh_and_original(self, x_tanh, clip_min, clip_max, clip_range=None):
+        """
+        Transform input from tanh to original space and also return the intermediate `np.tanh(x_tanh)`, which is
+        needed again when computing the gradient of the loss.
+
+        :param x_tanh: An array with the input to be transformed.
+        :type x_tanh: `np.ndarray`
+        :param clip_min: Minimum clipping values.
+        :type clip_min: `np.ndarray`
+        :param clip_max: Maximum clipping values.
+        :type clip_max: `np.ndarray`
+        :param clip_range: The difference `clip_max - clip_min`, if already computed.
+        :type clip_range: `np.ndarray`
+        :return: A tuple holding `np.tanh(x_tanh)` and the transformed input.
+        :rtype: `(np.ndarray, np.ndarray)`
+        """
+        tanh_x = np.tanh(x_tanh.astype(NUMPY_DTYPE, copy=False))
+        return tanh_x, self._tanh_to_original(x_tanh, clip_min, clip_max, tanh_x=tanh_x, clip_range=clip_range)
+
+    def _generate_samples(self, x_adv, y, line_search_buffers, batch_buffers, pool):
+        """
+        Optimize the adversarial examples of a set of samples in place. The optimization state of all of them is kept
+        throughout the optimization, while the classifier is queried in batches of at most `batch_size` samples. In
+        each iteration, the samples which are still being optimized are regrouped into full batches, so that samples
+        which already succeeded do not leave batches half empty.
+
+        :param x_adv: A C-contiguous array of type `NUMPY_DTYPE` with the original input, which is overwritten with the
+                adversarial examples where the attack succeeds.
+        :type x_adv: `np.ndarray`
+        :param y: A C-contiguous array of type `NUMPY_DTYPE` with the target classes (one-hot encoded).
+        :type y: `np.ndarray`
+        :param line_search_buffers: Two flat arrays of type `NUMPY_DTYPE` which hold the candidates of the line search,
+                large enough for `max(max_halving, max_doubling)` candidates of each sample of a full batch.
+        :type line_search_buffers: `(np.ndarray, np.ndarray)`
+        :param batch_buffers: Four arrays with the shape of a full batch, into which the rows of the original input,
+                the adversarial examples, their `np.tanh` in tanh space (all of type `NUMPY_DTYPE`) and the adversarial
+                examples in tanh space (of type `tanh_dtype`) of a batch are gathered.
+        :type batch_buffers: `tuple`
+        :param pool: A pool of `nb_threads` threads building the candidates of the line search, or `None`.
+        :type pool: :class:`multiprocessing.pool.ThreadPool`
+        """
+        # Per-sample factors are broadcast against a batch by reshaping them with these trailing dimensions:
+        trailing_dims = (1,) * (len(x_adv.shape) - 1)
+
+        # The factors of the candidate learning rates and the steps of the line search are the same in every iteration:
+        halving_factors = 2.0 ** -np.arange(self.max_halving)
+        doubling_factors = 2.0 ** np.arange(1, self.max_doubling + 1)
+        doubling_steps = np.arange(self.max_doubling)
+
+        target_idx = np.argmax(y, axis=1)
+
+        # If the clipping values of the classifier are scalars, the clipping values of the adversarial examples of a
+        # batch are computed from its original input (the unmodified x_adv) when they are needed, instead of keeping
+        # three arrays the size of all samples. Otherwise, they are computed once and gathered for each batch:
+        (clip_min_per_pixel, clip_max_per_pixel) = self.classifier.clip_values
+        if np.ndim(clip_min_per_pixel) == 0 and np.ndim(clip_max_per_pixel) == 0:
+            def clip_bounds(idx, x_batch):
+                return self._clip_bounds(x_batch)
+        else:
+            all_clip_bounds = self._clip_bounds(x_adv)
+
+            def clip_bounds(idx, x_batch):
+                return tuple(bound[idx] for bound in all_clip_bounds)
+
+        x_batch_buffer, x_adv_batch_buffer, tanh_x_adv_batch_buffer, x_adv_batch_tanh_buffer = batch_buffers
+
+        # The optimization is performed in tanh space to keep the adversarial images bounded from clip_min and
+        # clip_max. The adversarial examples are stored there with tanh_dtype:
+        x_adv_tanh = np.empty(x_adv.shape, dtype=self.tanh_dtype)
+        tanh_x_adv = np.empty_like(x_adv)
+
+        # Initialize optimization:
+        i_other, loss = [], []
+        for batch_index_1 in range(0, x_adv.shape[0], self.batch_size):
+            batch = slice(batch_index_1, batch_index_1 + self.batch_size)
+            clip_min, clip_max, clip_range = clip_bounds(batch, x_adv[batch])
+            x_adv_tanh[batch] = self._original_to_tanh(x_adv[batch], clip_min, clip_max,
+                                                       inv_clip_range=np.reciprocal(clip_range))
+            tanh_x_adv[batch] = np.tanh(x_adv_tanh[batch].astype(NUMPY_DTYPE, copy=False))
+
+            i_other_batch, loss_batch = self._loss(x_adv[batch], None, target_idx=target_idx[batch])
+            i_other.append(i_other_batch)
+            loss.append(loss_batch)
+        i_other, loss = np.concatenate(i_other), np.concatenate(loss)
+        attack_success = (loss <= 0)
+        lr = self.learning_rate * np.ones(x_adv.shape[0])
+        x_adv_opt = x_adv.copy()
+
+        # Number of consecutive iterations in which the line search did not decrease the loss of a sample:
+        nb_stale = np.zeros(x_adv.shape[0], dtype=int)
+        stalled = np.zeros(x_adv.shape[0], dtype=bool)
+
+        # The statistics in the debug messages require passes over the samples, which are skipped without DEBUG logging:
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        for it in range(self.max_iter):
+            logger.debug('Iteration step %i out of %i', it, self.max_iter)
+            if debug:
+                logger.debug('Average Loss: %f', np.mean(loss))
+                logger.debug('Successful attack samples: %i out of %i', int(np.sum(attack_success)), x_adv.shape[0])
+
+            # only continue optimization for those samples where attack hasn't succeeded yet and whose loss has
+            # not stalled. Gather and scatter them with an index vector instead of boolean masks:
+            remaining_idx = np.flatnonzero(~(attack_success | stalled))
+            if remaining_idx.shape[0] == 0:
+                break
+
+            # perform line search to optimize perturbation
+            # first, halve the learning rate until perturbation actually decreases the loss:
+            prev_loss = loss.copy()
+            best_loss = loss.copy()
+            best_lr = np.zeros(x_adv.shape[0])
+            halving = np.zeros(x_adv.shape[0])
+
+            # Indices of the largest non-target logits belonging to best_lr, which are reused when the adversarial
+            # samples are finally updated instead of querying the classifier again. They are only read where best_lr
+            # has been set:
+            i_other_best_lr = np.empty_like(i_other)
+
+            nb_batches = int(np.ceil(remaining_idx.shape[0] / float(self.batch_size)))
+            for batch_id in range(nb_batches):
+                logger.debug('Processing batch %i out of %i', batch_id, nb_batches)
+                active_idx = remaining_idx[batch_id * self.batch_size:(batch_id + 1) * self.batch_size]
+                x_batch = _take_rows(x_adv, active_idx, x_batch_buffer)
+                x_adv_batch = _take_rows(x_adv_opt, active_idx, x_adv_batch_buffer)
+                tanh_x_adv_batch = _take_rows(tanh_x_adv, active_idx, tanh_x_adv_batch_buffer)
+                x_adv_batch_tanh = _take_rows(x_adv_tanh, active_idx, x_adv_batch_tanh_buffer)
+                clip_min, clip_max, clip_range = clip_bounds(active_idx, x_batch)
+
+                # compute gradient:
+                logger.debug('Compute loss gradient')
+                perturbation_tanh = -self._gradient_of_loss(i_other[active_idx], y[active_idx], x_adv_batch,
+                                                            tanh_x_adv_batch, clip_min, clip_max,
+                                                            target_idx=target_idx[active_idx], clip_range=clip_range)
+                perturbation_tanh = perturbation_tanh.astype(self.tanh_dtype, copy=False)
+
+                # All candidate learning rates lr, lr/2, lr/4, ... are evaluated with a single classifier call; the
+                # search then stops for each sample at the first candidate which decreases the loss:
+                rows = np.arange(active_idx.shape[0])
+                lr_halving = lr[active_idx, np.newaxis] * halving_factors
+                i_other_halving, loss_halving = self._line_search_losses(
+                    x_adv_batch_tanh, perturbation_tanh, y[active_idx], lr_halving, clip_min, clip_max,
+                    target_idx=target_idx[active_idx], buffers=line_search_buffers, clip_range=clip_range, pool=pool)
+
+                stop_halving = ~(loss_halving >= prev_loss[active_idx, np.newaxis])
+                halving[active_idx] = np.where(np.any(stop_halving, axis=1), np.argmax(stop_halving, axis=1) + 1,
+                                               self.max_halving)
+                last = halving[active_idx].astype(int) - 1
+                if debug:
+                    logger.debug('Number of halving steps performed: %s', str(halving[active_idx]))
+
+                loss[active_idx] = loss_halving[rows, last]
+                lr[active_idx] = lr_halving[rows, last]
+                if debug:
+                    logger.debug('New Average Loss: %f', np.mean(loss))
+                    logger.debug('Loss: %s', str(loss))
+                    logger.debug('Prev_loss: %s', str(prev_loss))
+                    logger.debug('Best_loss: %s', str(best_loss))
+
+                improved = loss[active_idx] < best_loss[active_idx]
+                improved_idx = active_idx[improved]
+                best_lr[improved_idx] = lr[improved_idx]
+                best_loss[improved_idx] = loss[improved_idx]
+                i_other_best_lr[improved_idx] = i_other_halving[rows, last][improved]
+
+                # if no halving was actually required, double the learning rate as long as this
+                # decreases the loss:
+                do_doubling = (halving[active_idx] == 1) & (loss[active_idx] <= best_loss[active_idx])
+                if debug:
+                    logger.debug('Doubling to be performed on %i samples', int(np.sum(do_doubling)))
+                if np.any(do_doubling):
+                    doubling_idx = active_idx[do_doubling]
+                    rows = np.arange(doubling_idx.shape[0])
+                    lr_doubling = lr[doubling_idx, np.newaxis] * doubling_factors
+                    i_other_doubling, loss_doubling = self._line_search_losses(
+                        x_adv_batch_tanh[do_doubling], perturbation_tanh[do_doubling], y[doubling_idx], lr_doubling,
+                        clip_min[do_doubling], clip_max[do_doubling], target_idx=target_idx[doubling_idx],
+                        buffers=line_search_buffers, clip_range=clip_range[do_doubling], pool=pool)
+
+                    # The search stops at the first candidate which is worse than the best loss found before it:
+                    best_loss_before = np.concatenate((best_loss[doubling_idx, np.newaxis], loss_doubling[:, :-1]),
+                                                      axis=1)
+                    best_loss_before = np.minimum.accumulate(best_loss_before, axis=1)
+                    stop_doubling = ~(loss_doubling <= best_loss_before)
+                    last = np.where(np.any(stop_doubling, axis=1), np.argmax(stop_doubling, axis=1),
+                                    self.max_doubling - 1)
+                    if debug:
+                        logger.debug('Number of doubling steps performed: %s', str(last + 1))
+
+                    loss[doubling_idx] = loss_doubling[rows, last]
+                    lr[doubling_idx] = lr_doubling[rows, last]
+                    if debug:
+                        logger.debug('New Average Loss: %f', np.mean(loss))
+
+                    tried = (doubling_steps <= last[:, np.newaxis]) & ~np.isnan(loss_doubling)
+                    best = np.argmin(np.where(tried, loss_doubling, np.inf), axis=1)
+                    improved = loss_doubling[rows, best] < best_loss[doubling_idx]
+                    improved_idx = doubling_idx[improved]
+                    best_lr[improved_idx] = lr_doubling[rows, best][improved]
+                    best_loss[improved_idx] = loss_doubling[rows, best][improved]
+                    i_other_best_lr[improved_idx] = i_other_doubling[rows, best][improved]
+
+                lr[active_idx[halving[active_idx] == 1]] /= 2
+
+                update_adv = (best_lr[active_idx] > 0)
+                if debug:
+                    logger.debug('Number of adversarial samples to be finally updated: %i', int(np.sum(update_adv)))
+
+                if self.early_stop_patience is not None:
+                    nb_stale[active_idx] = np.where(update_adv, 0, nb_stale[active_idx] + 1)
+                    stalled[active_idx] = nb_stale[active_idx] >= self.early_stop_patience
+
+                if np.any(update_adv):
+                    update_idx = active_idx[update_adv]
+                    best_lr_mult = best_lr[update_idx].astype(NUMPY_DTYPE).reshape((-1,) + trailing_dims)
+
+                    x_adv_tanh[update_idx] = x_adv_batch_tanh[update_adv] + best_lr_mult * perturbation_tanh[update_adv]
+                    tanh_x_adv[update_idx], x_adv_opt[update_idx] = \
+                        self._tanh_and_original(x_adv_tanh[update_idx], clip_min[update_adv], clip_max[update_adv],
+                                                clip_range=clip_range[update_adv])
+                    i_other[update_idx] = i_other_best_lr[update_idx]
+                    loss[update_idx] = best_loss[update_idx]
+                    attack_success[update_idx] = (loss[update_idx] <= 0)
+
+                # Release the perturbation before the next one is computed, so that both are not held at once:
+                del perturbation_tanh
+
+            if debug:
+                logger.debug('Number of stalled samples: %i', int(np.sum(stalled)))
+
+        # Update depending on attack success:
+        x_adv[attack_success] = x_adv_opt[attack_success]
 
     def generate(self, x, **kwargs):
         """
@@ -626,7 +1493,9 @@ class CarliniLInfMethod(Attack):
         :return: An array holding the adversarial examples.
         :rtype: `np.ndarray`
         """
-        x_adv = x.astype(NUMPY_DTYPE)
+        # All arrays derived from the input are C-contiguous, so that gathering the rows of samples copies contiguous
+        # blocks whatever the memory layout of `x` is:
+        x_adv = x.astype(NUMPY_DTYPE, order='C')
 
         # Parse and save attack-specific parameters
         params_cpy = dict(kwargs)
@@ -641,144 +1510,43 @@ class CarliniLInfMethod(Attack):
         if y is None:
             y = get_labels_np_array(self._predict(x, logits=False))
 
-        # Compute perturbation with implicit batching
-        nb_batches = int(np.ceil(x_adv.shape[0] / float(self.batch_size)))
-        for batch_id in range(nb_batches):
-            logger.debug('Processing batch %i out of %i', batch_id, nb_batches)
-
-            batch_index_1, batch_index_2 = batch_id * self.batch_size, (batch_id + 1) * self.batch_size
-            x_batch = x_adv[batch_index_1:batch_index_2]
-            y_batch = y[batch_index_1:batch_index_2]
-
-            (clip_min_per_pixel, clip_max_per_pixel) = self.classifier.clip_values
-            clip_min = np.clip(x_batch - self.eps, clip_min_per_pixel, clip_max_per_pixel)
-            clip_max = np.clip(x_batch + self.eps, clip_min_per_pixel, clip_max_per_pixel)
-
-            # The optimization is performed in tanh space to keep the
-            # adversarial images bounded from clip_min and clip_max.
-            x_batch_tanh = self._original_to_tanh(x_batch, clip_min, clip_max)
-
-            # Initialize perturbation in tanh space:
-            x_adv_batch = x_batch.copy()
-            x_adv_batch_tanh = x_batch_tanh.copy()
-
-            # Initialize optimization:
-            z, loss = self._loss(x_adv_batch, y_batch)
-            attack_success = (loss <= 0)
-            lr = self.learning_rate * np.ones(x_batch.shape[0])
-
-            for it in range(self.max_iter):
-                logger.debug('Iteration step %i out of %i', it, self.max_iter)
-                logger.debug('Average Loss: %f', np.mean(loss))
-
-                logger.debug('Successful attack samples: %i out of %i', int(np.sum(attack_success)), x_batch.shape[0])
-
-                # only continue optimization for those samples where attack hasn't succeeded yet:
-                active = ~attack_success
-                if np.sum(active) == 0:
-                    break
-
-                # compute gradient:
-                logger.debug('Compute loss gradient')
-                perturbation_tanh = -self._gradient_of_loss(z[active], y_batch[active], x_adv_batch[active],
-                                                            x_adv_batch_tanh[active], clip_min[active], clip_max[active])
-
-                # perform line search to optimize perturbation
-                # first, halve the learning rate until perturbation actually decreases the loss:
-                prev_loss = loss.copy()
-                best_loss = loss.copy()
-                best_lr = np.zeros(x_batch.shape[0])
-                halving = np.zeros(x_batch.shape[0])
-
-                for h in range(self.max_halving):
-                    logger.debug('Perform halving iteration %i out of %i', h, self.max_halving)
-                    do_halving = (loss[active] >= prev_loss[active])
-                    logger.debug('Halving to be performed on %i samples', int(np.sum(do_halving)))
-                    if np.sum(do_halving) == 0:
-                        break
-                    active_and_do_halving = active.copy()
-                    active_and_do_halving[active] = do_halving
-
-                    lr_mult = lr[active_and_do_halving]
-                    for _ in range(len(x.shape)-1):
-                        lr_mult = lr_mult[:, np.newaxis]
-
-                    new_x_adv_batch_tanh = x_adv_batch_tanh[active_and_do_halving] + \
-                        lr_mult * perturbation_tanh[do_halving]
-                    new_x_adv_batch = self._tanh_to_original(new_x_adv_batch_tanh,
-                                                             clip_min[active_and_do_halving],
-                                                             clip_max[active_and_do_halving])
-                    _, loss[active_and_do_halving] = self._loss(new_x_adv_batch, y_batch[active_and_do_halving])
-                    logger.debug('New Average Loss: %f', np.mean(loss))
-                    logger.debug('Loss: %s', str(loss))
-                    logger.debug('Prev_loss: %s', str(prev_loss))
-                    logger.debug('Best_loss: %s', str(best_loss))
-
-                    best_lr[loss < best_loss] = lr[loss < best_loss]
-                    best_loss[loss < best_loss] = loss[loss < best_loss]
-                    lr[active_and_do_halving] /= 2
-                    halving[active_and_do_halving] += 1
-                lr[active] *= 2
-
-                # if no halving was actually required, double the learning rate as long as this
-                # decreases the loss:
-                for d in range(self.max_doubling):
-                    logger.debug('Perform doubling iteration %i out of %i', d, self.max_doubling)
-                    do_doubling = (halving[active] == 1) & (loss[active] <= best_loss[active])
-                    logger.debug('Doubling to be performed on %i samples', int(np.sum(do_doubling)))
-                    if np.sum(do_doubling) == 0:
-                        break
-                    active_and_do_doubling = active.copy()
-                    active_and_do_doubling[active] = do_doubling
-                    lr[active_and_do_doubling] *= 2
-
-                    lr_mult = lr[active_and_do_doubling]
-                    for _ in range(len(x.shape)-1):
-                        lr_mult = lr_mult[:, np.newaxis]
-
-                    new_x_adv_batch_tanh = x_adv_batch_tanh[active_and_do_doubling] + \
-                        lr_mult * perturbation_tanh[do_doubling]
-                    new_x_adv_batch = self._tanh_to_original(new_x_adv_batch_tanh,
-                                                             clip_min[active_and_do_doubling],
-                                                             clip_max[active_and_do_doubling])
-                    _, loss[active_and_do_doubling] = self._loss(new_x_adv_batch,
-                                                                 y_batch[active_and_do_doubling])
-                    logger.debug('New Average Loss: %f', np.mean(loss))
-                    best_lr[loss < best_loss] = lr[loss < best_loss]
-                    best_loss[loss < best_loss] = loss[loss < best_loss]
-
-                lr[halving == 1] /= 2
-
-                update_adv = (best_lr[active] > 0)
-                logger.debug('Number of adversarial samples to be finally updated: %i', int(np.sum(update_adv)))
-
-                if np.sum(update_adv) > 0:
-                    active_and_update_adv = active.copy()
-                    active_and_update_adv[active] = update_adv
-                    best_lr_mult = best_lr[active_and_update_adv]
-                    for _ in range(len(x.shape)-1):
-                        best_lr_mult = best_lr_mult[:, np.newaxis]
-
-                    x_adv_batch_tanh[active_and_update_adv] = x_adv_batch_tanh[active_and_update_adv] + \
-                        best_lr_mult * perturbation_tanh[update_adv]
-                    x_adv_batch[active_and_update_adv] = self._tanh_to_original(x_adv_batch_tanh[active_and_update_adv],
-                                                                                clip_min[active_and_update_adv],
-                                                                                clip_max[active_and_update_adv])
-                    z[active_and_update_adv], loss[active_and_update_adv] = self._loss(
-                        x_adv_batch[active_and_update_adv], y_batch[active_and_update_adv])
-                    attack_success = (loss <= 0)
-
-            # Update depending on attack success:
-            x_adv_batch[~attack_success] = x_batch[~attack_success]
-            x_adv[batch_index_1:batch_index_2] = x_adv_batch
-
-        adv_preds = np.argmax(self._predict(x_adv), axis=1)
-        if self.targeted:
-            rate = np.sum(adv_preds == np.argmax(y, axis=1)) / x_adv.shape[0]
-        else:
-            preds = np.argmax(self._predict(x), axis=1)
-            rate = np.sum(adv_preds != preds) / x_adv.shape[0]
-        logger.info('Success rate of C&W attack: %.2f%%', 100 * rate)
+        # The candidates of the line search are written to two flat buffers, which are large enough for the longer of
+        # both searches on a full batch and are reused throughout the attack:
+        buffer_size = x_adv[:self.batch_size].size * max(self.max_halving, self.max_doubling)
+        line_search_buffers = (np.empty(buffer_size, dtype=NUMPY_DTYPE), np.empty(buffer_size, dtype=NUMPY_DTYPE))
+
+        # The rows of the samples being optimized are gathered into buffers for a full batch, which are reused
+        # throughout the attack instead of allocating new arrays for every batch:
+        batch_shape = (min(self.batch_size, x_adv.shape[0]),) + x_adv.shape[1:]
+        batch_buffers = (np.empty(batch_shape, dtype=NUMPY_DTYPE), np.empty(batch_shape, dtype=NUMPY_DTYPE),
+                         np.empty(batch_shape, dtype=NUMPY_DTYPE), np.empty(batch_shape, dtype=self.tanh_dtype))
+
+        # By default, the input is optimized batch by batch, so that the optimization state is bounded by batch_size.
+        # With regroup_batches, the state is kept for the whole input and the samples still being optimized are
+        # regrouped into full batches in every iteration:
+        y = np.ascontiguousarray(y, dtype=NUMPY_DTYPE)
+        chunk_size = max(x_adv.shape[0], 1) if self.regroup_batches else self.batch_size
+
+        # The candidates of the line search are built by nb_threads threads, which are shut down whatever happens:
+        pool = ThreadPool(self.nb_threads) if self.nb_threads > 1 else None
+        try:
+            for chunk_index in range(0, x_adv.shape[0], chunk_size):
+                chunk = slice(chunk_index, chunk_index + chunk_size)
+                self._generate_samples(x_adv[chunk], y[chunk], line_search_buffers, batch_buffers, pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # The success rate costs additional predictions and is only computed if it is going to be logged:
+        if self.compute_success_rate and logger.isEnabledFor(logging.INFO):
+            adv_preds = np.argmax(self._predict(x_adv), axis=1)
+            if self.targeted:
+                rate = np.sum(adv_preds == np.argmax(y, axis=1)) / x_adv.shape[0]
+            else:
+                preds = np.argmax(self._predict(x), axis=1)
+                rate = np.sum(adv_preds != preds) / x_adv.shape[0]
+            logger.info('Success rate of C&W attack: %.2f%%', 100 * rate)
 
         return x_adv
 
@@ -803,10 +1571,34 @@ class CarliniLInfMethod(Attack):
         :type eps: `float`
         :param batch_size: Internal size of batches on which adversarial samples are generated.
         :type batch_size: `int`
+        :param compute_success_rate: Log the success rate of the attack at the end of `generate`.
+        :type compute_success_rate: `bool`
+        :param tanh_dtype: Floating point type in which the adversarial examples and perturbations in tanh space are
+               stored.
+        :type tanh_dtype: `type`
+        :param early_stop_patience: Stop optimizing a sample once the line search has not decreased its loss for this
+               many consecutive iterations.
+        :type early_stop_patience: `int`
+        :param nb_threads: Number of threads building the candidates of the line search.
+        :type nb_threads: `int`
+        :param regroup_batches: Keep the optimization state of the whole input and regroup the samples which are still
+               being optimized into full batches in every iteration, at the cost of memory growing with the input.
+        :type regroup_batches: `bool`
         """
         # Save attack-specific parameters
         super(CarliniLInfMethod, self).set_params(**kwargs)
 
+        if not np.issubdtype(self.tanh_dtype, np.floating) or \
+                np.dtype(self.tanh_dtype).itemsize > np.dtype(NUMPY_DTYPE).itemsize:
+            raise ValueError("The tanh dtype must be a floating point type not wider than NUMPY_DTYPE.")
+
+        if self.early_stop_patience is not None and \
+                (not isinstance(self.early_stop_patience, (int, np.int)) or self.early_stop_patience < 1):
+            raise ValueError("The early stopping patience must be None or an integer greater than zero.")
+
+        if not isinstance(self.nb_threads, (int, np.int)) or self.nb_threads < 1:
+            raise ValueError("The number of threads must be an integer greater than zero.")
+
         if self.eps <= 0:
             raise ValueError("The eps parameter must be strictly positive.")
 
@@ -38,6 +38,26 @@ logger = logging.getLogger('testLogger')
 BATCH_SIZE, NB_TRAIN, NB_TEST = 100, 5000, 10
 
 
+def _count_predicted_samples(classifier):
+    """
+    Wrap the `predict` method of a classifier to record the number of samples of each call.
+
+    :param classifier: The classifier whose predictions are counted.
+    :type classifier: :class:`Classifier`
+    :return: A list to which the number of samples of each subsequent call of `classifier.predict` is appended.
+    :rtype: `list`
+    """
+    predict = classifier.predict
+    nb_samples = []
+
+    def counting_predict(x, *args, **kwargs):
+        nb_samples.append(x.shape[0])
+        return predict(x, *args, **kwargs)
+
+    classifier.predict = counting_predict
+    return nb_samples
+
+
 class Model(nn.Module):
     def __init__(self):
         super(Model, self).__init__()
@@ -297,6 +317,147 @@ class TestCarliniL2(unittest.TestCase):
         logger.info('CW2 Success Rate: %.2f', (sum(y_pred != y_pred_adv) / float(len(y_pred))))
         self.assertTrue((y_pred != y_pred_adv).any())
 
+    def test_update_const(self):
+        """
+        Test the update of the constants of the binary search.
+        :return:
+        """
+        cl2m = CarliniL2Method(classifier=self._cnn_mnist_k([28, 28, 1]))
+
+        # The samples succeed with doubling, fail with doubling, succeed without doubling and fail without doubling:
+        c = np.array([1., 1., 4., 4.])
+        c_lower_bound = np.array([0., 0., 2., 2.])
+        c_double = np.array([True, True, False, False])
+        attack_success = np.array([True, False, True, False])
+        c, c_lower_bound, c_double = cl2m._update_const(c, c_lower_bound, c_double, attack_success)
+
+        # On success, c is halved towards its lower bound and never doubled again. On failure, c becomes the new
+        # lower bound and is either doubled or increased by half its distance to the previous lower bound:
+        np.testing.assert_array_equal(c, [.5, 2., 3., 5.])
+        np.testing.assert_array_equal(c_lower_bound, [0., 1., 2., 4.])
+        np.testing.assert_array_equal(c_double, [False, True, False, False])
+
+    def test_parallel_c(self):
+        """
+        Test the concurrent optimization of the constants of the binary search.
+        :return:
+        """
+        # Get MNIST
+        (x_train, y_train), (x_test, y_test) = self.mnist
+
+        # Get classifier
+        krc = self._cnn_mnist_k([28, 28, 1])
+        krc.fit(x_train, y_train, batch_size=BATCH_SIZE, nb_epochs=10)
+
+        # Attack
+        cl2m = CarliniL2Method(classifier=krc, targeted=True, max_iter=10, binary_search_steps=3, parallel_c=True)
+        params = {'y': random_targets(y_test, krc.nb_classes)}
+        x_test_adv = cl2m.generate(x_test, **params)
+        self.assertFalse((x_test == x_test_adv).all())
+        self.assertTrue((x_test_adv <= 1.0001).all())
+        self.assertTrue((x_test_adv >= -0.0001).all())
+        target = np.argmax(params['y'], axis=1)
+        y_pred_adv = np.argmax(krc.predict(x_test_adv), axis=1)
+        self.assertTrue((target == y_pred_adv).any())
+
+        # Constants exceeding the upper bound are never optimized, hence the original examples are returned:
+        cl2m = CarliniL2Method(classifier=krc, targeted=True, max_iter=10, binary_search_steps=2, parallel_c=True,
+                               initial_const=1e12)
+        x_test_adv = cl2m.generate(x_test, **params)
+        np.testing.assert_array_almost_equal(x_test, x_test_adv, 3)
+
+    def test_early_stop_tol(self):
+        """
+        Test the early stopping of samples for which a close enough adversarial example has been found.
+        :return:
+        """
+        # Get MNIST
+        (x_train, y_train), (x_test, y_test) = self.mnist
+
+        # Get classifier
+        krc = self._cnn_mnist_k([28, 28, 1])
+        krc.fit(x_train, y_train, batch_size=BATCH_SIZE, nb_epochs=10)
+        params = {'y': random_targets(y_test, krc.nb_classes)}
+
+        # The default tolerance of zero never stops a sample early:
+        cl2m = CarliniL2Method(classifier=krc, targeted=True, max_iter=10)
+        nb_predicted = _count_predicted_samples(krc)
+        x_test_adv = cl2m.generate(x_test, **params)
+        nb_predicted_full = sum(nb_predicted)
+        cl2m = CarliniL2Method(classifier=krc, targeted=True, max_iter=10, early_stop_tol=0.)
+        np.testing.assert_array_equal(x_test_adv, cl2m.generate(x_test, **params))
+
+        # With a large tolerance, samples stop at their first success and are no longer passed to the classifier:
+        cl2m = CarliniL2Method(classifier=krc, targeted=True, max_iter=10, early_stop_tol=1e6)
+        nb_predicted = _count_predicted_samples(krc)
+        x_test_adv = cl2m.generate(x_test, **params)
+        self.assertLess(sum(nb_predicted), nb_predicted_full)
+        self.assertTrue((x_test_adv <= 1.0001).all())
+        self.assertTrue((x_test_adv >= -0.0001).all())
+
+        # Negative tolerances are rejected:
+        with self.assertRaises(ValueError):
+            CarliniL2Method(classifier=krc, early_stop_tol=-1.)
+
+    def test_clip_values_per_feature(self):
+        """
+        Test the attack with clipping values given per feature.
+        :return:
+        """
+        # Get MNIST
+        (x_train, y_train), (x_test, y_test) = self.mnist
+
+        # The upper half of each image may only be perturbed within [0, 0.5], the lower half within [0, 1]:
+        clip_min = np.zeros(x_test.shape[1:])
+        clip_max = np.ones(x_test.shape[1:])
+        clip_max[:14] = 0.5
+        x_test = np.clip(x_test, clip_min, clip_max)
+
+        # Get classifier
+        krc = self._cnn_mnist_k([28, 28, 1], clip_values=(clip_min, clip_max))
+        krc.fit(x_train, y_train, batch_size=BATCH_SIZE, nb_epochs=10)
+
+        # Attack
+        cl2m = CarliniL2Method(classifier=krc, targeted=True, max_iter=10)
+        params = {'y': random_targets(y_test, krc.nb_classes)}
+        x_test_adv = cl2m.generate(x_test, **params)
+        self.assertFalse((x_test == x_test_adv).all())
+        self.assertTrue((x_test_adv <= clip_max + 0.0001).all())
+        self.assertTrue((x_test_adv >= clip_min - 0.0001).all())
+        target = np.argmax(params['y'], axis=1)
+        y_pred_adv = np.argmax(krc.predict(x_test_adv), axis=1)
+        self.assertTrue((target == y_pred_adv).any())
+
+    def test_compute_success_rate(self):
+        """
+        Test that the success rate, which costs additional predictions, is only computed if requested.
+        :return:
+        """
+        # Get MNIST
+        (_, _), (x_test, y_test) = self.mnist
+
+        krc = self._cnn_mnist_k([28, 28, 1])
+        params = {'y': random_targets(y_test, krc.nb_classes)}
+
+        # The success rate is only computed if it is logged:
+        attack_logger = logging.getLogger('art.attacks.carlini')
+        level = attack_logger.level
+        attack_logger.setLevel(logging.INFO)
+        try:
+            nb_predicted = _count_predicted_samples(krc)
+            cl2m = CarliniL2Method(classifier=krc, targeted=True, max_iter=1, binary_search_steps=1)
+            cl2m.generate(x_test, **params)
+            nb_calls = len(nb_predicted)
+
+            # Without the success rate, the single prediction of the targeted attack after the optimization is skipped:
+            nb_predicted = _count_predicted_samples(krc)
+            cl2m = CarliniL2Method(classifier=krc, targeted=True, max_iter=1, binary_search_steps=1,
+                                   compute_success_rate=False)
+            cl2m.generate(x_test, **params)
+            self.assertEqual(len(nb_predicted), nb_calls - 1)
+        finally:
+            attack_logger.setLevel(level)
+
     def test_ptclassifier(self):
         """
         Third test with the PyTorchClassifier.
@@ -350,6 +511,25 @@ class TestCarliniL2(unittest.TestCase):
         y_pred_adv = np.argmax(ptc.predict(x_test_adv), axis=1)
         self.assertTrue((y_pred != y_pred_adv).any())
 
+    @staticmethod
+    def _cnn_mnist_k(input_shape, clip_values=(0, 1)):
+        # Initialize a tf session
+        session = tf.Session()
+        k.set_session(session)
+
+        # Create simple CNN
+        model = Sequential()
+        model.add(Conv2D(4, kernel_size=(5, 5), activation='relu', input_shape=input_shape))
+        model.add(MaxPooling2D(pool_size=(2, 2)))
+        model.add(Flatten())
+        model.add(Dense(10, activation='softmax'))
+
+        model.compile(loss=keras.losses.categorical_crossentropy, optimizer=keras.optimizers.Adam(lr=0.01),
+                      metrics=['accuracy'])
+
+        classifier = KerasClassifier(clip_values, model, use_logits=False)
+        return classifier
+
 
 class TestCarliniLInf(unittest.TestCase):
     """
@@ -588,6 +768,144 @@ class TestCarliniLInf(unittest.TestCase):
         logger.info('CW0 Success Rate: %.2f', (sum(y_pred != y_pred_adv) / float(len(y_pred))))
         self.assertTrue((y_pred != y_pred_adv).any())
 
+    def test_tanh_dtype(self):
+        """
+        Test the optimization in tanh space with a reduced floating point precision.
+        :return:
+        """
+        # Get MNIST
+        (x_train, y_train), (x_test, y_test) = self.mnist
+
+        # Get classifier
+        krc = self._cnn_mnist_k([28, 28, 1])
+        krc.fit(x_train, y_train, batch_size=BATCH_SIZE, nb_epochs=10)
+
+        # Attack
+        clinfm = CarliniLInfMethod(classifier=krc, targeted=True, max_iter=10, eps=0.5, tanh_dtype=np.float16)
+        params = {'y': random_targets(y_test, krc.nb_classes)}
+        x_test_adv = clinfm.generate(x_test, **params)
+        self.assertFalse((x_test == x_test_adv).all())
+        self.assertTrue((x_test_adv <= 1.0001).all())
+        self.assertTrue((x_test_adv >= -0.0001).all())
+        self.assertTrue((np.abs(x_test_adv - x_test) <= 0.5001).all())
+        target = np.argmax(params['y'], axis=1)
+        y_pred_adv = np.argmax(krc.predict(x_test_adv), axis=1)
+        self.assertTrue((target == y_pred_adv).any())
+
+        # Types wider than NUMPY_DTYPE and non-floating point types are rejected:
+        with self.assertRaises(ValueError):
+            CarliniLInfMethod(classifier=krc, tanh_dtype=np.float64)
+        with self.assertRaises(ValueError):
+            CarliniLInfMethod(classifier=krc, tanh_dtype=np.int32)
+
+    def test_early_stop_patience(self):
+        """
+        Test the early stopping of samples whose loss is no longer decreased by the line search.
+        :return:
+        """
+        # Get MNIST
+        (x_train, y_train), (x_test, y_test) = self.mnist
+
+        # Get classifier
+        krc = self._cnn_mnist_k([28, 28, 1])
+        krc.fit(x_train, y_train, batch_size=BATCH_SIZE, nb_epochs=10)
+        params = {'y': random_targets(y_test, krc.nb_classes)}
+
+        # Without patience, samples are optimized for max_iter iterations or until the attack succeeds. A small eps
+        # and a large learning rate make samples stall at the bounds of the perturbation:
+        clinfm = CarliniLInfMethod(classifier=krc, targeted=True, max_iter=20, learning_rate=1., eps=0.1)
+        nb_predicted = _count_predicted_samples(krc)
+        x_test_adv = clinfm.generate(x_test, **params)
+        nb_predicted_full = sum(nb_predicted)
+        clinfm = CarliniLInfMethod(classifier=krc, targeted=True, max_iter=20, learning_rate=1., eps=0.1,
+                                   early_stop_patience=None)
+        np.testing.assert_array_equal(x_test_adv, clinfm.generate(x_test, **params))
+
+        # Stalled samples are no longer passed to the classifier:
+        clinfm = CarliniLInfMethod(classifier=krc, targeted=True, max_iter=20, learning_rate=1., eps=0.1,
+                                   early_stop_patience=1)
+        nb_predicted = _count_predicted_samples(krc)
+        x_test_adv = clinfm.generate(x_test, **params)
+        self.assertLess(sum(nb_predicted), nb_predicted_full)
+        self.assertTrue((x_test_adv <= 1.0001).all())
+        self.assertTrue((x_test_adv >= -0.0001).all())
+
+        # The patience must be a positive integer:
+        with self.assertRaises(ValueError):
+            CarliniLInfMethod(classifier=krc, early_stop_patience=0)
+
+    def test_nb_threads(self):
+        """
+        Test building the candidates of the line search in several threads.
+        :return:
+        """
+        # Get MNIST
+        (x_train, y_train), (x_test, y_test) = self.mnist
+
+        # Get classifier
+        krc = self._cnn_mnist_k([28, 28, 1])
+        krc.fit(x_train, y_train, batch_size=BATCH_SIZE, nb_epochs=10)
+        params = {'y': random_targets(y_test, krc.nb_classes)}
+
+        # The samples are split among the threads, which does not change the result:
+        clinfm = CarliniLInfMethod(classifier=krc, targeted=True, max_iter=10, eps=0.5)
+        x_test_adv = clinfm.generate(x_test, **params)
+        clinfm = CarliniLInfMethod(classifier=krc, targeted=True, max_iter=10, eps=0.5, nb_threads=3)
+        np.testing.assert_array_equal(x_test_adv, clinfm.generate(x_test, **params))
+
+        # The number of threads must be a positive integer:
+        with self.assertRaises(ValueError):
+            CarliniLInfMethod(classifier=krc, nb_threads=0)
+
+    def test_compute_success_rate(self):
+        """
+        Test that the success rate, which costs additional predictions, is only computed if requested.
+        :return:
+        """
+        # Get MNIST
+        (_, _), (x_test, y_test) = self.mnist
+
+        krc = self._cnn_mnist_k([28, 28, 1])
+        params = {'y': random_targets(y_test, krc.nb_classes)}
+
+        # The success rate is only computed if it is logged:
+        attack_logger = logging.getLogger('art.attacks.carlini')
+        level = attack_logger.level
+        attack_logger.setLevel(logging.INFO)
+        try:
+            nb_predicted = _count_predicted_samples(krc)
+            clinfm = CarliniLInfMethod(classifier=krc, targeted=True, max_iter=1, eps=0.5)
+            clinfm.generate(x_test, **params)
+            nb_calls = len(nb_predicted)
+
+            # Without the success rate, the single prediction of the targeted attack after the optimization is skipped:
+            nb_predicted = _count_predicted_samples(krc)
+            clinfm = CarliniLInfMethod(classifier=krc, targeted=True, max_iter=1, eps=0.5, compute_success_rate=False)
+            clinfm.generate(x_test, **params)
+            self.assertEqual(len(nb_predicted), nb_calls - 1)
+        finally:
+            attack_logger.setLevel(level)
+
+    def test_regroup_batches(self):
+        """
+        Test keeping the optimization state of the whole input and regrouping the samples being optimized.
+        :return:
+        """
+        # Get MNIST
+        (x_train, y_train), (x_test, y_test) = self.mnist
+
+        # Get classifier
+        krc = self._cnn_mnist_k([28, 28, 1])
+        krc.fit(x_train, y_train, batch_size=BATCH_SIZE, nb_epochs=10)
+        params = {'y': random_targets(y_test, krc.nb_classes)}
+
+        # The samples are optimized independently of each other, hence regrouping them does not change the result:
+        clinfm = CarliniLInfMethod(classifier=krc, targeted=True, max_iter=10, eps=0.5, batch_size=3)
+        x_test_adv = clinfm.generate(x_test, **params)
+        clinfm = CarliniLInfMethod(classifier=krc, targeted=True, max_iter=10, eps=0.5, batch_size=3,
+                                   regroup_batches=True)
+        np.testing.assert_array_equal(x_test_adv, clinfm.generate(x_test, **params))
+
     def test_ptclassifier(self):
         """
         Third test with the PyTorchClassifier.
@@ -641,6 +959,25 @@ class TestCarliniLInf(unittest.TestCase):
         y_pred_adv = np.argmax(ptc.predict(x_test_adv), axis=1)
         self.assertTrue((y_pred != y_pred_adv).any())
 
+    @staticmethod
+    def _cnn_mnist_k(input_shape):
+        # Initialize a tf session
+        session = tf.Session()
+        k.set_session(session)
+
+        # Create simple CNN
+        model = Sequential()
+        model.add(Conv2D(4, kernel_size=(5, 5), activation='relu', input_shape=input_shape))
+        model.add(MaxPooling2D(pool_size=(2, 2)))
+        model.add(Flatten())
+        model.add(Dense(10, activation='softmax'))
+
+        model.compile(loss=keras.losses.categorical_crossentropy, optimizer=keras.optimizers.Adam(lr=0.01),
+                      metrics=['accuracy'])
+
+        classifier = KerasClassifier((0, 1), model, use_logits=False)
+        return classifier
+
 
 if __name__ == '__main__':
     unittest.main()